@@ -1,81 +1,372 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chess
+import numpy as np
+
+from services.profile_registry import ProfileRegistry
+from services.radar_context import RAW_FEATURES
 from services.radar_service import RadarService
+from services.stockfish_service import BATCH
 
 
 class EvaluationHandler:
     def __init__(self, *args, **kwargs):
         self.stockfish_service = kwargs.get('stockfish_service')
         self.radar_service = kwargs.get('radar_service')
+        self.profile_registry = kwargs.get('profile_registry')
+        # Whole game analysis: engines to spread the searches over (all of
+        # the pool by default) and radar feature worker processes
+        self.engine_workers = kwargs.get('engine_workers')
+        self.radar_workers = kwargs.get('radar_workers', 1)
 
     @staticmethod
-    def build(stockfish_service):
+    def build(stockfish_service, engine_workers=None, radar_workers=None, radar_executor=None):
+        if radar_workers is None:
+            # Every process of the radar pool, when there is one
+            radar_workers = radar_executor._max_workers if radar_executor else 1
         radar_service = RadarService.build(
             stockfish_service,
             stats_file='trained_stats_MagnusCarlsen_1000_2023-06-26.json',
-            normalize_scores=True)
+            normalize_scores=True,
+            opening_index=stockfish_service.opening_index,
+            executor=radar_executor)
+        profile_registry = ProfileRegistry.build('.', watch_interval=5)
         return EvaluationHandler(
             stockfish_service=stockfish_service,
-            radar_service=radar_service
+            radar_service=radar_service,
+            profile_registry=profile_registry,
+            engine_workers=engine_workers,
+            radar_workers=radar_workers,
         )
 
-    def calculate_game_evaluations(self, fen, moves):
-        results = {
-            'evaluations': [],
-            'radar_features': []
+    def get_profile(self, profile):
+        """Resolves the `profile` of a request ({'username', 'gameCount', 'date'}
+        or just a username) to a RadarProfile. None keeps the default profile."""
+        if not profile:
+            return None
+        if isinstance(profile, str):
+            profile = {'username': profile}
+        radar_profile = self.profile_registry.get(
+            username=profile.get('username'),
+            game_count=profile.get('gameCount'),
+            date=profile.get('date'),
+        )
+        if radar_profile is None:
+            raise Exception(f'No trained stats found for profile {profile}')
+        return radar_profile
+
+    def list_profiles(self):
+        return self.profile_registry.list_profiles()
+
+    def get_cache_stats(self):
+        feature_cache = self.radar_service.feature_cache
+        evaluation_cache = self.stockfish_service.evaluation_cache
+        opening_index = self.stockfish_service.opening_index
+        return {
+            'radar_features': feature_cache.get_stats() if feature_cache else None,
+            'engine_evaluations': evaluation_cache.get_stats() if evaluation_cache else None,
+            'opening_index': opening_index.get_stats() if opening_index else None,
         }
-        stockfish = self.stockfish_service.get_stockfish()
-        stockfish.set_fen_position(fen)
+
+    def get_engine_stats(self):
+        return self.stockfish_service.get_stats()
+
+    def calculate_game_evaluations(self, fen, moves, profile=None, engine_workers=None, radar_workers=None, depth=None, budget=None, session=None):
+        """Evaluates every position of a game. The positions are derived up
+        front, so the engine searches are spread over several engines while
+        the radar features are computed alongside them.
+
+        Args:
+            fen (string): Starting position
+            moves (list): Moves in uci notation
+            profile (dict|string): Radar normalization profile
+            engine_workers (int): Engines to use, defaults to the handler's
+            radar_workers (int): Radar feature processes, defaults to the handler's
+            depth (int): Search depth of every position
+            budget (dict): 'movetime', 'nodes' and/or 'deadline' anytime limits,
+                see StockfishService.get_evaluations
+            session (string): Game or session id that keeps its engine warm
+
+        Returns:
+            dict: {'evaluations', 'depths', 'radar_features'} in ply order
+        """
+        radar_profile = self.get_profile(profile)
+        board = chess.Board(fen)
+        fens = []
         for move in moves:
-            stockfish.make_moves_from_current_position([move])
-            curr_fen = stockfish.get_fen_position()
-            results['evaluations'].append(
-                stockfish.get_evaluation().get('value'))
-            results['radar_features'].append(
-                self.radar_service.get_features_by_fen(curr_fen))
-        return results
-
-    def calculate_position_evaluation(self, fen):
-        stockfish = self.stockfish_service.get_stockfish()
-        stockfish.set_fen_position(fen)
-        evaluation = stockfish.get_evaluation().get('value')
-        radar_features = self.radar_service.get_features_by_fen(fen)
+            board.push_uci(move)
+            fens.append(board.fen())
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            radar_features = executor.submit(
+                self.radar_service.get_features_by_moves,
+                fen, moves, radar_profile, radar_workers or self.radar_workers)
+            evaluations = self.stockfish_service.get_evaluations(
+                fens,
+                workers=engine_workers or self.engine_workers or len(self.stockfish_service.engines),
+                depth=depth,
+                budget=budget,
+                session=session,
+                priority=BATCH)
+            return {
+                'evaluations': [evaluation.get('value') for evaluation in evaluations],
+                'depths': [evaluation.get('depth') for evaluation in evaluations],
+                'radar_features': self.radar_service.to_feature_dicts(radar_features.result()),
+            }
+
+    def calculate_adaptive_game_evaluations(self, fen, moves, profile=None, engine_workers=None, radar_workers=None, shallow_depth=6, depth=None, swing=100, feature_spike=3, max_deepened=None, budget=None, session=None):
+        """Evaluates every position of a game with a shallow search, then
+        searches again, deeper, only the critical plies: where the shallow
+        evaluation swings by at least `swing` centipawns, or where the raw
+        `strong_threats` or `forks` score of either side jumps by at least
+        `feature_spike`.
+
+        Args:
+            fen (string): Starting position
+            moves (list): Moves in uci notation
+            profile (dict|string): Radar normalization profile
+            engine_workers (int): Engines to use, defaults to the handler's
+            radar_workers (int): Radar feature processes, defaults to the handler's
+            shallow_depth (int): Search depth of the first pass
+            depth (int): Search depth of the critical plies, defaults to the pool's
+            swing (int): Evaluation change, in centipawns, that makes a ply critical
+            feature_spike (float): Raw threat or fork score increase, in
+                piece values, that makes a ply critical
+            max_deepened (int): Most plies to search again, most critical first
+            budget (dict): 'movetime', 'nodes' and/or 'deadline' anytime limits,
+                see StockfishService.get_evaluations. 'movetime' and 'nodes'
+                apply to every search of both passes; 'deadline' covers the
+                whole game: the first pass shares it and the critical plies
+                share what is left of it
+            session (string): Game or session id that keeps its engine warm
+
+        Returns:
+            dict: {'evaluations', 'depths', 'radar_features', 'deepened'} with
+                the plies that were searched again in 'deepened'
+        """
+        radar_profile = self.get_profile(profile)
+        stop_at = None
+        if budget and budget.get('deadline'):
+            stop_at = time.monotonic() + budget['deadline'] / 1000
+
+        def get_pass_budget():
+            # The deadline of each pass is what is left of the game's
+            if stop_at is None:
+                return budget
+            return {**budget, 'deadline': (stop_at - time.monotonic()) * 1000}
+
+        workers = engine_workers or self.engine_workers or len(self.stockfish_service.engines)
+        board = chess.Board(fen)
+        fens = []
+        for move in moves:
+            board.push_uci(move)
+            fens.append(board.fen())
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            raw = executor.submit(
+                self.radar_service.get_raw_features_by_moves,
+                fen, moves, radar_workers or self.radar_workers)
+            evaluations = self.stockfish_service.get_evaluations(
+                fens, workers=workers, depth=shallow_depth,
+                budget=get_pass_budget(), session=session, priority=BATCH)
+            raw = raw.result()
+        critical = self.get_critical_plies(
+            evaluations, raw, swing, feature_spike)[:max_deepened]
+        deep_budget = get_pass_budget()
+        if stop_at is not None and deep_budget['deadline'] < 1:
+            critical = []
+        if critical:
+            deep_evaluations = self.stockfish_service.get_evaluations(
+                [fens[ply] for ply in critical],
+                new_game=False,
+                workers=workers,
+                depth=depth or self.stockfish_service.depth,
+                budget=deep_budget,
+                session=session,
+                priority=BATCH)
+            for ply, evaluation in zip(critical, deep_evaluations):
+                # A deadline may cut the deeper search short of the first pass
+                if evaluation.get('depth', 0) > evaluations[ply].get('depth', 0):
+                    evaluations[ply] = evaluation
+        return {
+            'evaluations': [evaluation.get('value') for evaluation in evaluations],
+            'depths': [evaluation.get('depth') for evaluation in evaluations],
+            'radar_features': self.radar_service.to_feature_dicts(
+                self.radar_service.normalize_batch(raw, radar_profile)),
+            'deepened': sorted(critical),
+        }
+
+    @staticmethod
+    def get_critical_plies(evaluations, raw, swing=100, feature_spike=3):
+        """Plies of a shallow game analysis worth a deeper search, most
+        critical first. An evaluation swing marks both plies around it: the
+        move may have lost the evaluation, or the shallow search misjudged
+        the position before it.
+
+        Args:
+            evaluations (list): Evaluation of every ply
+            raw (np.ndarray): Raw radar features of every ply
+            swing (int): Evaluation change, in centipawns
+            feature_spike (float): Raw `strong_threats` or `forks` increase
+
+        Returns:
+            list: Ply indexes
+        """
+        scores = [EvaluationHandler.get_centipawns(evaluation) for evaluation in evaluations]
+        spike_features = [RAW_FEATURES.index(feature) for feature in ('strong_threats', 'forks')]
+        spikes = np.zeros(len(raw))
+        if len(raw) > 1:
+            spikes[1:] = (raw[1:, spike_features] - raw[:-1, spike_features]).max(axis=(1, 2))
+        priorities = {}
+        for ply in range(len(evaluations)):
+            if ply and scores[ply] is not None and scores[ply - 1] is not None:
+                change = abs(scores[ply] - scores[ply - 1])
+                if change >= swing:
+                    for critical in (ply - 1, ply):
+                        priorities[critical] = max(priorities.get(critical, 0), change)
+            if spikes[ply] >= feature_spike:
+                # Ranked against the swings as if the spike moved the evaluation
+                priorities[ply] = max(
+                    priorities.get(ply, 0), swing * spikes[ply] / feature_spike)
+        return sorted(priorities, key=lambda ply: (-priorities[ply], ply))
+
+    @staticmethod
+    def get_centipawns(evaluation, mate_score=10000):
+        """Centipawn value of an evaluation, mates scored as +/-`mate_score`.
+        None when the position has no evaluation."""
+        if not evaluation:
+            return None
+        if evaluation['type'] == 'mate':
+            return mate_score if evaluation['value'] >= 0 else -mate_score
+        return evaluation['value']
+
+    def stream_game_evaluations(self, fen, moves, profile=None, depth=None, budget=None, session=None):
+        """Yields the evaluation and radar features of each ply as soon as they
+        are computed. An engine is only checked out for one search at a time,
+        so closing the generator (the client went away) stops the analysis
+        before the next ply.
+
+        Args:
+            fen (string): Starting position
+            moves (list): Moves in uci notation
+            profile (dict|string): Radar normalization profile
+            depth (int): Search depth of every position
+            budget (dict): 'movetime', 'nodes' and/or 'deadline' anytime limits
+            session (string): Game or session id that keeps its engine warm
+
+        Returns:
+            generator: {'ply', 'move', 'evaluation', 'depth', 'radar_features'}
+        """
+        radar_profile = self.get_profile(profile)
+        board = chess.Board(fen)
+        radar_features = self.radar_service.iter_features_by_moves(
+            fen, moves, radar_profile)
+        stop_at = None
+        if budget and budget.get('deadline'):
+            stop_at = time.monotonic() + budget['deadline'] / 1000
+        for ply, move in enumerate(moves):
+            board.push_uci(move)
+            if stop_at is not None:
+                # What is left of the deadline, shared by the remaining plies
+                budget = {**budget, 'deadline': max(
+                    1, (stop_at - time.monotonic()) * 1000 / (len(moves) - ply))}
+            evaluation = self.stockfish_service.get_evaluation(
+                board.fen(), new_game=ply == 0, depth=depth, budget=budget,
+                session=session, priority=BATCH)
+            yield {
+                'ply': ply,
+                'move': move,
+                'evaluation': evaluation.get('value'),
+                'depth': evaluation.get('depth'),
+                'radar_features': self.radar_service.to_feature_dicts(
+                    next(radar_features)[None])[0],
+            }
+
+    def calculate_position_evaluation(self, fen, profile=None, depth=None, budget=None, session=None):
+        radar_profile = self.get_profile(profile)
+        evaluation = self.stockfish_service.get_evaluation(
+            fen, depth=depth, budget=budget, session=session)
+        radar_features = self.radar_service.to_feature_dicts(
+            self.radar_service.get_features_batch([fen], radar_profile))[0]
         return {
-            'evaluation': evaluation,
+            'evaluation': evaluation.get('value'),
+            'depth': evaluation.get('depth'),
             'radar_features': radar_features,
         }
 
-    def generate_previews(self, fen, preview_count, depth):
-        stockfish = self.stockfish_service.get_stockfish()
-        stockfish.set_fen_position(fen)
-        previews = []
-        top_moves = self.stockfish_service.get_top_moves(fen, preview_count)
+    def generate_previews(self, fen, preview_count, depth, profile=None, session=None):
+        """Builds `preview_count` lines of `depth` moves from one MultiPV search.
+        Every ply of a line is scored with its principal variation's score; a
+        line is only searched again from its end when its PV is too short."""
+        radar_profile = self.get_profile(profile)
+        # A preview set that loses its engine is searched again on another one
+        previews, preview_fens = self.stockfish_service.run(
+            lambda stockfish: self.search_previews(
+                stockfish, fen, preview_count, depth, session),
+            session=session)
+
+        # Score every preview position in one batch, then split it back per line
+        radar_features = self.radar_service.to_feature_dicts(
+            self.radar_service.get_features_batch(
+                [f for fens in preview_fens for f in fens], radar_profile))
+        offset = 0
+        for preview, fens in zip(previews, preview_fens):
+            preview['radar_features'] = radar_features[offset:offset + len(fens)]
+            offset += len(fens)
+        return previews
+
+    def search_previews(self, stockfish, fen, preview_count, depth, session=None):
+        """The lines of `generate_previews`, searched on `stockfish`.
 
-        for start_move in top_moves:
-            stockfish.reset_engine_parameters()
-            stockfish.set_fen_position(fen)
+        Returns:
+            tuple: (previews, fens of every preview after its first move)
+        """
+        previews = []
+        preview_fens = []
+        lines = self.stockfish_service.get_principal_variations(
+            fen, preview_count, stockfish, session=session)
+        for line in lines:
             preview = {
                 'startingPosition': fen,
                 'moves': [],
                 'evaluations': [],
                 'radar_features': []
             }
-            start_move = start_move.get('Move')
-            preview['moves'].append(start_move)
-            stockfish.make_moves_from_current_position([start_move])
-            preview['evaluations'].append(
-                stockfish.get_evaluation().get('value'))
-            for _ in range(depth - 1):
-                best_move = stockfish.get_best_move()
-                preview['moves'].append(best_move)
-                stockfish.make_moves_from_current_position([best_move])
-                curr_fen = stockfish.get_fen_position()
-                preview['radar_features'].append(
-                    self.radar_service.get_features_by_fen(curr_fen))
-                preview['evaluations'].append(
-                    stockfish.get_evaluation().get('value'))
-                if not best_move:
-                    preview['moves'].append('')
-                    preview['evaluations'].append(0)
-                    continue
+            board = chess.Board(fen)
+            fens = []
+            while line and line['moves']:
+                turn = board.turn
+                moves = line['moves'][:depth - len(preview['moves'])]
+                for ply, move in enumerate(moves, 1):
+                    board.push_uci(move)
+                    preview['moves'].append(move)
+                    preview['evaluations'].append(
+                        self.get_line_evaluation(line, turn, ply))
+                    if len(preview['moves']) > 1:
+                        fens.append(board.fen())
+                if len(preview['moves']) >= depth or board.is_game_over():
+                    break
+                line = next(iter(self.stockfish_service.get_principal_variations(
+                    board.fen(), 1, stockfish, new_game=False)), None)
+            # Lines that end in mate or stalemate are padded to `depth`
+            while len(preview['moves']) < depth:
+                preview['moves'].append('')
+                preview['evaluations'].append(0)
             previews.append(preview)
+            preview_fens.append(fens)
+        return previews, preview_fens
 
-        return previews
+    @staticmethod
+    def get_line_evaluation(line, turn, ply):
+        """Score of the position `ply` moves into a PV: the line's score, with
+        mate distances counted down by the moves the mating side has played.
+
+        Args:
+            line (dict): {'moves', 'type', 'value'} from get_principal_variations
+            turn (bool): Side to move at the start of the line, chess.WHITE or chess.BLACK
+            ply (int): Moves played along the line
+        """
+        if line['type'] != 'mate' or not line['value']:
+            return line['value']
+        mating_side = line['value'] > 0
+        remaining = abs(line['value']) - (ply + (turn == mating_side)) // 2
+        return remaining if mating_side else -remaining
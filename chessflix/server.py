@@ -1,20 +1,51 @@
-from flask import Flask, request, jsonify
+import atexit
+import json
+import os
+
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 
+from services.evaluation_cache import EvaluationCache
+from services.opening_index import OpeningIndex
+from services.radar_service import RadarService
 from services.stockfish_service import StockfishService
 from handlers.evaluation_handler import EvaluationHandler
 
 app = Flask(__name__)
 CORS(app, origins=['http://localhost:3000'], allow_headers='Content-Type')
 
+DEBUG = True
+
+# Radar workers are forked first, while the process has no other threads. The
+# debug reloader also runs this module in its file watching parent process,
+# which serves no requests and is left without a pool
+radar_executor = None
+if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    radar_executor = RadarService.start_workers()
+    atexit.register(radar_executor.shutdown, cancel_futures=True)
+
+evaluation_cache = EvaluationCache.build('evaluation_cache.db')
+opening_index = OpeningIndex.build('opening_index.npz')
 try:
     stockfish_service = StockfishService.build(
-        path='/opt/homebrew/bin/stockfish')
+        path='/opt/homebrew/bin/stockfish', evaluation_cache=evaluation_cache,
+        opening_index=opening_index)
     # stockfish_service = StockfishService.build(path='/usr/local/bin/stockfish')
 except Exception as e:
     stockfish_service = StockfishService.build(
-        path='/opt/homebrew/bin/stockfish')
-eval_handler = EvaluationHandler.build(stockfish_service)
+        path='/usr/local/bin/stockfish', evaluation_cache=evaluation_cache,
+        opening_index=opening_index)
+eval_handler = EvaluationHandler.build(stockfish_service, radar_executor=radar_executor)
+
+
+def get_budget(req):
+    """Anytime search limits of an eval request, None without any."""
+    budget = {
+        limit: req.get(limit)
+        for limit in ('movetime', 'nodes', 'deadline')
+        if req.get(limit)
+    }
+    return budget or None
 
 
 @app.route('/', methods=['GET'])
@@ -24,17 +55,59 @@ def test_server():
 
 @app.route('/reset', methods=['POST'])
 def reset():
-    stockfish_service.build(path='/opt/homebrew/bin/stockfish')
+    """Replaces every engine process; requests queue until the new ones are up."""
+    stockfish_service.restart()
     return jsonify({'message': 'Stockfish reset'})
 
 
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    return jsonify(eval_handler.list_profiles())
+
+
+@app.route('/stats/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(eval_handler.get_cache_stats())
+
+
+@app.route('/stats/engines', methods=['GET'])
+def engine_stats():
+    return jsonify(eval_handler.get_engine_stats())
+
+
 @app.route('/eval/game', methods=['POST'])
 def calculate_game_evals():
     try:
         req = request.json
         fen = req.get('fen')
         moves = req.get('moves')
-        payload = eval_handler.calculate_game_evaluations(fen, moves)
+        adaptive = req.get('adaptive')
+        if adaptive:
+            payload = eval_handler.calculate_adaptive_game_evaluations(
+                fen,
+                moves,
+                req.get('profile'),
+                engine_workers=req.get('engineWorkers'),
+                radar_workers=req.get('radarWorkers'),
+                shallow_depth=adaptive.get('shallowDepth', 6),
+                depth=req.get('depth'),
+                swing=adaptive.get('swing', 100),
+                feature_spike=adaptive.get('featureSpike', 3),
+                max_deepened=adaptive.get('maxDeepened'),
+                budget=get_budget(req),
+                session=req.get('sessionId'),
+            )
+            return jsonify(payload)
+        payload = eval_handler.calculate_game_evaluations(
+            fen,
+            moves,
+            req.get('profile'),
+            engine_workers=req.get('engineWorkers'),
+            radar_workers=req.get('radarWorkers'),
+            depth=req.get('depth'),
+            budget=get_budget(req),
+            session=req.get('sessionId'),
+        )
         print(payload)
         return jsonify(payload)
     except Exception as e:
@@ -42,11 +115,64 @@ def calculate_game_evals():
         return jsonify({'error': 'Something went wrong'})
 
 
+def get_stream_request():
+    """Parameters of a /eval/game/stream request: the JSON body of a POST, or
+    the query string of a GET, which is all an EventSource can send
+    (?fen=...&moves=e2e4,e7e5&profile=username&depth=12&sessionId=...)."""
+    if request.method == 'POST':
+        return request.json
+    req = {key: request.args.get(key) for key in ('fen', 'profile', 'sessionId')}
+    req['moves'] = request.args.get('moves', '').replace(',', ' ').split()
+    for key in ('depth', 'movetime', 'nodes', 'deadline'):
+        req[key] = request.args.get(key, type=int)
+    return req
+
+
+@app.route('/eval/game/stream', methods=['GET', 'POST'])
+def stream_game_evals():
+    """/eval/game as Server-Sent Events: one `ply` event per move as soon as
+    it is evaluated, then `done`. The analysis stops when the client
+    disconnects. Browsers can read it with an EventSource (GET, query
+    parameters) or with fetch (POST, JSON body)."""
+    req = get_stream_request()
+    results = eval_handler.stream_game_evaluations(
+        req.get('fen'),
+        req.get('moves'),
+        req.get('profile'),
+        depth=req.get('depth'),
+        budget=get_budget(req),
+        session=req.get('sessionId'),
+    )
+
+    def events():
+        try:
+            for result in results:
+                yield f'event: ply\ndata: {json.dumps(result)}\n\n'
+            yield 'event: done\ndata: {}\n\n'
+        except Exception as e:
+            print(e)
+            yield f'event: error\ndata: {json.dumps({"error": "Something went wrong"})}\n\n'
+        finally:
+            # Also runs when the server closes the stream of a gone client
+            results.close()
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @app.route('/eval/position', methods=['POST'])
 def calculate_position_eval():
     try:
-        fen = request.json.get('fen')
-        payload = eval_handler.calculate_position_evaluation(fen)
+        req = request.json
+        payload = eval_handler.calculate_position_evaluation(
+            req.get('fen'),
+            req.get('profile'),
+            depth=req.get('depth'),
+            budget=get_budget(req),
+            session=req.get('sessionId'),
+        )
         print(payload)
         return jsonify(payload)
     except Exception as e:
@@ -60,7 +186,13 @@ def calculate_previews():
         fen = request.json['fen']
         preview_count = int(request.json['previewCount'])
         depth = int(request.json['depth'])
-        payload = eval_handler.generate_previews(fen, preview_count, depth)
+        payload = eval_handler.generate_previews(
+            fen,
+            preview_count,
+            depth,
+            request.json.get('profile'),
+            session=request.json.get('sessionId'),
+        )
         print(payload)
         return jsonify(payload)
     except Exception as e:
@@ -69,4 +201,4 @@ def calculate_previews():
 
 
 if __name__ == '__main__':
-    app.run(port=5000, debug=True)
+    app.run(port=5000, debug=DEBUG)
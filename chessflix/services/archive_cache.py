@@ -0,0 +1,119 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+
+class ArchiveCache:
+    """SQLite cache of chess.com API responses, keyed by URL.
+
+    Bodies are stored zlib compressed together with their `ETag` and
+    `Last-Modified` validators. A monthly archive fetched after its month
+    ended can no longer change and is served without touching the network;
+    anything else (the current month, the list of archives) is revalidated
+    with a conditional request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.connection = kwargs.get('connection')
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.downloads = 0
+
+    @staticmethod
+    def build(path='archive_cache.db'):
+        """Opens (or creates) the cache.
+
+        Args:
+            path (string): SQLite file, ':memory:' keeps everything in process
+
+        Returns:
+            ArchiveCache: Archive cache
+        """
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'url TEXT PRIMARY KEY, '
+            'etag TEXT, '
+            'last_modified TEXT, '
+            'fetched_at REAL NOT NULL, '
+            'body BLOB NOT NULL)'
+        )
+        connection.commit()
+        return ArchiveCache(connection=connection)
+
+    def get(self, url):
+        """Cached response of `url` ({'data', 'etag', 'last_modified',
+        'fetched_at'}), or None."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified, fetched_at, body FROM responses WHERE url = ?',
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            'data': json.loads(zlib.decompress(row[3])),
+            'etag': row[0],
+            'last_modified': row[1],
+            'fetched_at': row[2],
+        }
+
+    def put(self, url, content, etag=None, last_modified=None):
+        """Stores the raw JSON `content` of a response."""
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (url, etag, last_modified, fetched_at, body) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (url, etag, last_modified, time.time(), zlib.compress(content)),
+            )
+            self.connection.commit()
+            self.downloads += 1
+
+    def touch(self, url):
+        """Records that `url` was revalidated and has not changed."""
+        with self.lock:
+            self.connection.execute(
+                'UPDATE responses SET fetched_at = ? WHERE url = ?', (time.time(), url))
+            self.connection.commit()
+            self.revalidations += 1
+
+    def record_hit(self):
+        with self.lock:
+            self.hits += 1
+
+    @staticmethod
+    def is_complete(url, fetched_at):
+        """Whether `url` is a monthly archive fetched after its month ended."""
+        match = re.search(r'/games/(\d{4})/(\d{2})/?$', url)
+        if match is None:
+            return False
+        year, month = int(match.group(1)), int(match.group(2))
+        month_end = datetime(
+            year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc).timestamp()
+        return fetched_at >= month_end
+
+    def get_stats(self):
+        with self.lock:
+            stored, size = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM responses').fetchone()
+            return {
+                'entries': stored,
+                'bytes': size,
+                'hits': self.hits,
+                'revalidations': self.revalidations,
+                'downloads': self.downloads,
+            }
+
+
+if __name__ == '__main__':
+    cache = ArchiveCache.build(':memory:')
+    url = 'https://api.chess.com/pub/player/magnuscarlsen/games/2023/01'
+    cache.put(url, b'{"games": []}', etag='"abc"')
+    print(cache.get(url), ArchiveCache.is_complete(url, time.time()))
+    print(cache.get_stats())
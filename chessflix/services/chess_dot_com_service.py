@@ -1,83 +1,318 @@
-import requests
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from chessflix.services.archive_cache import ArchiveCache
+from chessflix.services.lru_cache import LRUCache
+from chessflix.services.pgn_reader import read_headers
 
 
 class ChessDotComService:
-    def __init__(self):
-        pass
+    """Client of the chess.com public API.
+
+    Requests go through one pooled `requests.Session`, so connections are kept
+    alive between calls. Monthly archives (streamed by
+    `iter_games_by_username`) and opponent profiles are fetched
+    concurrently on up to `max_workers` threads, with at most `per_host`
+    requests in flight to any one host; rate limited (429) and failed (5xx)
+    requests are retried with backoff.
+
+    Opponent profiles are fetched once per id, even by concurrent requests,
+    and kept in a TTL cache shared by every request, optionally saved to
+    `profile_cache_file`. Failed lookups are cached too, for the shorter
+    `negative_ttl`.
+
+    Archive responses go through the optional on-disk ArchiveCache: completed
+    months are read from disk, the current month and the archive list are
+    revalidated with conditional requests. In `offline` mode nothing is
+    requested at all and only cached data is returned.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.base_url = kwargs.get('base_url', 'https://api.chess.com')
+        self.session = kwargs.get('session') or requests.Session()
+        self.max_workers = kwargs.get('max_workers', 8)
+        # Monthly archives downloaded ahead of the one being read
+        self.read_ahead = kwargs.get('read_ahead', 1)
+        self.per_host = kwargs.get('per_host', 4)
+        # Seconds to wait for a response
+        self.timeout = kwargs.get('timeout', 10)
+        self.host_limits = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        # profile url -> profile, or None for a failed lookup. An empty cache
+        # is falsy, so it is tested against None
+        self.profile_cache = kwargs.get('profile_cache')
+        if self.profile_cache is None:
+            self.profile_cache = LRUCache.build(max_entries=10000, ttl=86400)
+        self.negative_ttl = kwargs.get('negative_ttl', 600)
+        # profile url -> future of a fetch in progress
+        self.profile_fetches = {}
+        self.profile_cache_file = kwargs.get('profile_cache_file')
+        self.archive_cache = kwargs.get('archive_cache')
+        self.offline = kwargs.get('offline', False)
 
     @staticmethod
-    def build():
-        return ChessDotComService()
+    def build(base_url='https://api.chess.com', max_workers=8, per_host=4, timeout=10, retries=3, profile_cache_size=10000, profile_ttl=86400, negative_ttl=600, profile_cache_file=None, archive_cache_file=None, offline=False, read_ahead=1):
+        """Creates the client, its connection pool and profile cache.
+
+        Args:
+            base_url (string): API root, e.g. a local stub server
+            max_workers (int): Requests in flight at once
+            per_host (int): Requests in flight to a single host
+            timeout (float): Seconds to wait for a response
+            retries (int): Retries of a rate limited or failed request
+            profile_cache_size (int): Opponent profiles kept in memory
+            profile_ttl (float): Seconds a fetched profile is reused
+            negative_ttl (float): Seconds a failed profile lookup is not retried
+            profile_cache_file (string): JSON file the profile cache is loaded
+                from and saved to, None keeps it in memory only
+            archive_cache_file (string): SQLite file of the archive cache,
+                None disables it
+            offline (bool): Serve only what is cached, without any request
+            read_ahead (int): Monthly archives downloaded ahead of the one
+                whose games are being read
+
+        Returns:
+            ChessDotComService: chess.com client
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_workers,
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+            ),
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['User-Agent'] = 'chess-flix-server'
+        profile_cache = LRUCache.build(max_entries=profile_cache_size, ttl=profile_ttl)
+        if profile_cache_file and os.path.exists(profile_cache_file):
+            ChessDotComService.load_profiles(profile_cache, profile_cache_file)
+        return ChessDotComService(
+            base_url=base_url,
+            session=session,
+            max_workers=max_workers,
+            per_host=per_host,
+            timeout=timeout,
+            profile_cache=profile_cache,
+            negative_ttl=negative_ttl,
+            profile_cache_file=profile_cache_file,
+            archive_cache=ArchiveCache.build(archive_cache_file) if archive_cache_file else None,
+            offline=offline,
+            read_ahead=read_ahead,
+        )
 
     def get_games_by_username(self, username, get_pgns=False, limit=1000):
-        archives_url = f'https://api.chess.com/pub/player/{username}/games/archives'
+        return list(self.iter_games_by_username(username, get_pgns, limit))
+
+    def iter_games_by_username(self, username, get_pgns=False, limit=1000):
+        """Yields the games (or PGNs) of `username`, newest month first, and
+        stops after exactly `limit` of them.
+
+        While the games of one month are consumed, up to `read_ahead` of the
+        following months are downloaded, so only a few months are ever held
+        in memory. No further archive is requested once the games read plus
+        the games already downloaded reach `limit`, or after the generator is
+        closed.
+
+        Args:
+            username (string): chess.com username
+            get_pgns (bool): Yield PGN strings instead of game summaries
+            limit (int): Games to yield, None for all of them
+
+        Returns:
+            generator: Games or PGN strings
+        """
+        positioned_games = self.iter_positioned_games(username, get_pgns, limit)
+        try:
+            for _, game in positioned_games:
+                yield game
+        finally:
+            positioned_games.close()
+
+    def iter_positioned_games(self, username, get_pgns=False, limit=1000, after=None):
+        """`iter_games_by_username`, with every game paired with its position
+        (archive url, index in the archive, games the archive had when it was
+        read). Archives only ever grow at the end, so a position keeps
+        pointing at the same game, and resuming `after` it yields the games
+        that followed it then, whatever was played since.
+
+        Args:
+            username (string): chess.com username
+            get_pgns (bool): Yield PGN strings instead of game summaries
+            limit (int): Games to yield, None for all of them
+            after (tuple): Position of the last game already read, None to
+                start with the newest month
+
+        Returns:
+            generator: (position, game or PGN string) tuples
+        """
+        if limit is not None and limit <= 0:
+            return
+        archives_url = f'{self.base_url}/pub/player/{username}/games/archives'
         archives = self.get_archives(archives_url)[::-1]
-        games = []
-        for archive in archives:
-            ith_games = self.__get_games(archive, username.lower(), get_pgns)
-            games.extend(ith_games)
-            if len(games) >= limit:
-                break
-        return games
-
-    def __get_games(self, archive_url, username='tobiahsrex', get_pgns=False):
+        start, stop = 0, None
+        if after is not None:
+            archive, index, size = after
+            if archive not in archives:
+                raise Exception(f'{archive} is not an archive of {username}')
+            archives = archives[archives.index(archive):]
+            start, stop = index + 1, size
+        archives = iter(archives)
+        executor = self.get_executor()
+        pending = deque()
+        count = 0
+        buffered = 0
+
+        def read_ahead():
+            while len(pending) < self.read_ahead and (limit is None or count + buffered < limit):
+                archive = next(archives, None)
+                if archive is None:
+                    return
+                pending.append((archive, executor.submit(self.get_archive, archive)))
+
         try:
-            response = requests.get(archive_url)
+            read_ahead()
+            while pending:
+                archive, future = pending.popleft()
+                games = self.__get_games(future.result(), username.lower(), get_pgns)
+                size = len(games) if stop is None else min(stop, len(games))
+                games = games[start:size]
+                offset = start
+                start, stop = 0, None
+                buffered = len(games)
+                read_ahead()
+                for index, game in enumerate(games, offset):
+                    buffered -= 1
+                    yield (archive, index, size), game
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def get(self, url, headers=None):
+        """GETs `url`, holding one of its host's `per_host` slots."""
+        if self.offline:
+            raise requests.exceptions.ConnectionError(f'{url} is not cached (offline)')
+        host = urlparse(url).netloc
+        with self.lock:
+            host_limit = self.host_limits.setdefault(
+                host, threading.BoundedSemaphore(self.per_host))
+        with host_limit:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
             response.raise_for_status()
-            data = response.json()
-            games_result = []
-            if data:
-                for game in data.get('games', []):
-                    if get_pgns:
-                        games_result.append(game['pgn'])
-                        continue
-                    is_white = game['white']['username'].lower() == username
-                    my_win = game['white']['result'] == 'win' if is_white else game['black']['result'] == 'win'
-                    meta_data = game['pgn'].split('\n')
-                    date = next(line[7:17]
-                                for line in meta_data if line.startswith('[Date'))
-                    start_time = next(
-                        line[12:20] for line in meta_data if line.startswith('[StartTime'))
-                    end_time = next(
-                        line[10:18] for line in meta_data if line.startswith('[EndTime'))
-                    start_time, end_time = self.parse_time(
-                        start_time, end_time, date)
-                    opponent_id = game.get('black', {}).get(
-                        '@id') if is_white else game.get('white', {}).get('@id')
-                    opponent_profile = self.get_profile(opponent_id)
-                    template = {
-                        'username': username,
-                        'avatar': 'https://images.chesscomfiles.com/uploads/v1/user/92675886.c4235591.200x200o.d93954e125ad.jpeg',
-                        'name': opponent_profile.get('name', ''),
-                        'url': opponent_profile.get('url', ''),
-                        'location': 'San Francisco, CA',
-                    }
-                    result = {
-                        'white': {
-                            **game.get('white', ''),
-                            'avatar': template.get('avatar', '') if is_white else opponent_profile.get('avatar', '')
-                        },
-                        'black': {
-                            **game.get('black', ''),
-                            'avatar': opponent_profile.get('avatar', '') if is_white else template.get('avatar', ''),
-                        },
-                        'time_class': game.get('time_class', ''),
-                        'time_control': f"{int(game.get('time_control', '').split('+')[0]) / 60} min",
-                        'start_time': start_time,
-                        'end_time': end_time,
-                        'my_color': 'white' if is_white else 'black',
-                        'my_rating': game.get('white', {}).get('rating', 0) if is_white else game.get('black', {}).get('rating', 0),
-                        'result': 'win' if my_win else 'loss' if not my_win else 'draw',
-                        'link': game.get('url', ''),
-                        'pgn': game.get('pgn', ''),
-                        'url': game.get('url', ''),
-                    }
-                    games_result.append(result)
-            return games_result
+            return response
+
+    def get_json(self, url):
+        return self.get(url).json()
+
+    def get_cached_json(self, url):
+        """`get_json` through the archive cache. A cached completed month (or,
+        offline, anything cached) is returned as is; otherwise the cached
+        copy is revalidated and only downloaded again when it changed."""
+        if self.archive_cache is None:
+            return self.get_json(url)
+        cached = self.archive_cache.get(url)
+        if cached is not None and (
+                self.offline or ArchiveCache.is_complete(url, cached['fetched_at'])):
+            self.archive_cache.record_hit()
+            return cached['data']
+        headers = {}
+        if cached is not None and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached is not None and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+        response = self.get(url, headers)
+        if response.status_code == 304 and cached is not None:
+            self.archive_cache.touch(url)
+            return cached['data']
+        data = response.json()
+        self.archive_cache.put(
+            url,
+            response.content,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+        )
+        return data
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self.executor
+
+    def get_archive(self, archive_url):
+        try:
+            return self.get_cached_json(archive_url)
         except requests.exceptions.RequestException as error:
             print('Error fetching games:', error)
-            return []
+            return None
+
+    def __get_games(self, data, username='tobiahsrex', get_pgns=False):
+        games_result = []
+        if not data:
+            return games_result
+        games = data.get('games', [])
+        if get_pgns:
+            return [game['pgn'] for game in games]
+        # Every opponent profile of the month is requested at once
+        opponent_ids = [
+            game.get('black', {}).get('@id')
+            if game['white']['username'].lower() == username
+            else game.get('white', {}).get('@id')
+            for game in games
+        ]
+        opponent_profiles = self.get_profiles(opponent_ids)
+        for game, opponent_profile in zip(games, opponent_profiles):
+            is_white = game['white']['username'].lower() == username
+            my_win = game['white']['result'] == 'win' if is_white else game['black']['result'] == 'win'
+            headers, _ = read_headers(game['pgn'])
+            start_time, end_time = self.parse_time(
+                headers['StartTime'], headers['EndTime'], headers['Date'])
+            template = {
+                'username': username,
+                'avatar': 'https://images.chesscomfiles.com/uploads/v1/user/92675886.c4235591.200x200o.d93954e125ad.jpeg',
+                'name': opponent_profile.get('name', ''),
+                'url': opponent_profile.get('url', ''),
+                'location': 'San Francisco, CA',
+            }
+            result = {
+                'white': {
+                    **game.get('white', ''),
+                    'avatar': template.get('avatar', '') if is_white else opponent_profile.get('avatar', '')
+                },
+                'black': {
+                    **game.get('black', ''),
+                    'avatar': opponent_profile.get('avatar', '') if is_white else template.get('avatar', ''),
+                },
+                'time_class': game.get('time_class', ''),
+                'time_control': f"{int(game.get('time_control', '').split('+')[0]) / 60} min",
+                'start_time': start_time,
+                'end_time': end_time,
+                'my_color': 'white' if is_white else 'black',
+                'my_rating': game.get('white', {}).get('rating', 0) if is_white else game.get('black', {}).get('rating', 0),
+                'result': 'win' if my_win else 'loss' if not my_win else 'draw',
+                'link': game.get('url', ''),
+                'pgn': game.get('pgn', ''),
+                'url': game.get('url', ''),
+            }
+            games_result.append(result)
+        return games_result
 
     def parse_time(self, start_time, end_time, date):
         start = datetime.strptime(f"{date} {start_time}", "%Y.%m.%d %H:%M:%S")
@@ -90,11 +325,60 @@ class ChessDotComService:
         start_time = start_dt.strftime("%Y.%m.%d %H:%M:%S")
         return start_time, end_time
 
+    def get_profiles(self, profile_urls):
+        """Profiles of `profile_urls`, in order. Every id missing from the
+        cache is fetched once, however often it appears, and a lookup of an
+        id another request is already fetching waits for that fetch.
+
+        Returns:
+            list: Profile dicts, empty for ids that could not be fetched
+        """
+        profile_urls = list(profile_urls)
+        profiles = {}
+        missing = []
+        for url in dict.fromkeys(profile_urls):
+            profile = self.profile_cache.get(url, False)
+            if profile is False:
+                missing.append(url)
+            else:
+                profiles[url] = profile
+        if missing and self.offline:
+            # Left empty, not cached as failures, until the service is online
+            profiles.update(dict.fromkeys(missing))
+        elif missing:
+            executor = self.get_executor()
+            fetches = {}
+            started = []
+            with self.lock:
+                for url in missing:
+                    # Cached by a fetch that finished since the lookup above
+                    profile = self.profile_cache.peek(url, False)
+                    if profile is not False:
+                        profiles[url] = profile
+                        continue
+                    if url not in self.profile_fetches:
+                        self.profile_fetches[url] = executor.submit(self.fetch_profile, url)
+                        started.append(url)
+                    fetches[url] = self.profile_fetches[url]
+            for url, fetch in fetches.items():
+                profiles[url] = fetch.result()
+            for url in started:
+                # Cached before the fetch is dropped, so no lookup misses both
+                self.profile_cache.put(
+                    url, profiles[url], None if profiles[url] is not None else self.negative_ttl)
+                with self.lock:
+                    del self.profile_fetches[url]
+            if started:
+                self.save_profiles()
+        return [profiles[url] or {} for url in profile_urls]
+
     def get_profile(self, profile_url):
+        return self.get_profiles([profile_url])[0]
+
+    def fetch_profile(self, profile_url):
+        """Fetches a profile, None when the request fails."""
         try:
-            response = requests.get(profile_url)
-            response.raise_for_status()
-            data = response.json()
+            data = self.get_json(profile_url)
             return {
                 'username': data.get('username', ''),
                 'avatar': data.get('avatar', 'https://e7.pngegg.com/pngimages/980/304/png-clipart-computer-icons-user-profile-avatar-heroes-silhouette-thumbnail.png'),
@@ -104,20 +388,38 @@ class ChessDotComService:
             }
         except requests.exceptions.RequestException as error:
             print('Error fetching profile:', error)
-            return []
+            return None
+
+    def save_profiles(self):
+        """Writes the profile cache to `profile_cache_file`, if there is one."""
+        if not self.profile_cache_file:
+            return
+        with self.lock:
+            tmp_file = f'{self.profile_cache_file}.tmp'
+            f = open(tmp_file, 'w')
+            f.write(json.dumps({'profiles': self.profile_cache.items()}))
+            f.close()
+            os.replace(tmp_file, self.profile_cache_file)
+
+    @staticmethod
+    def load_profiles(profile_cache, profile_cache_file):
+        f = open(profile_cache_file, 'r')
+        profiles = json.load(f)['profiles']
+        f.close()
+        now = time.time()
+        for url, profile, expires in profiles:
+            if expires is None or expires > now:
+                profile_cache.put(url, profile, None if expires is None else expires - now)
 
     def get_archives(self, archives_url):
         try:
-            response = requests.get(archives_url)
-            response.raise_for_status()
-            data = response.json()
-            return data['archives']
+            return self.get_cached_json(archives_url)['archives']
         except requests.exceptions.RequestException as error:
             print('Error fetching archives:', error)
             return []
 
 
 if __name__ == '__main__':
-    chess_dot_com = ChessDotComService()
+    chess_dot_com = ChessDotComService.build()
     games = chess_dot_com.get_games_by_username('MagnusCarlsen', get_pgns=True)
     print(len(games))
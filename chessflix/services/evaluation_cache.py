@@ -0,0 +1,119 @@
+import sqlite3
+import threading
+
+import chess
+
+from chessflix.services.lru_cache import LRUCache
+
+
+class EvaluationCache:
+    """Two-tier cache of engine evaluations: an in-memory LRU in front of a
+    SQLite file.
+
+    Entries are keyed by the normalized position (EPD: placement, side to
+    move, castling rights and a legal en passant square; move counters are
+    ignored) and the engine version, and hold the deepest evaluation seen.
+    A lookup at depth d is satisfied by any entry searched to depth >= d.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.memory = kwargs.get('memory')
+        self.connection = kwargs.get('connection')
+        self.lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_misses = 0
+
+    @staticmethod
+    def build(path='evaluation_cache.db', max_entries=100000):
+        """Opens (or creates) the on-disk store.
+
+        Args:
+            path (string): SQLite file, ':memory:' keeps everything in process
+            max_entries (int): Entries of the in-memory tier
+
+        Returns:
+            EvaluationCache: Evaluation cache
+        """
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS evaluations ('
+            'position TEXT NOT NULL, '
+            'engine TEXT NOT NULL, '
+            'depth INTEGER NOT NULL, '
+            'type TEXT NOT NULL, '
+            'value INTEGER NOT NULL, '
+            'PRIMARY KEY (position, engine))'
+        )
+        connection.commit()
+        return EvaluationCache(
+            memory=LRUCache.build(max_entries=max_entries),
+            connection=connection,
+        )
+
+    @staticmethod
+    def get_position_key(fen):
+        return chess.Board(fen).epd()
+
+    def get(self, fen, engine, depth):
+        """Returns the cached evaluation ({'type', 'value', 'depth'}) of `fen`
+        searched to at least `depth`, or None."""
+        key = (self.get_position_key(fen), engine)
+        # A too shallow entry is a miss
+        entry = self.memory.get(key, accept=lambda entry: entry[0] >= depth)
+        # The disk may hold a deeper entry than one evicted and stored again
+        if entry is None:
+            with self.lock:
+                row = self.connection.execute(
+                    'SELECT depth, type, value FROM evaluations '
+                    'WHERE position = ? AND engine = ?',
+                    key,
+                ).fetchone()
+                if row is None or row[0] < depth:
+                    self.disk_misses += 1
+                    return None
+                self.disk_hits += 1
+            entry = (row[0], {'type': row[1], 'value': row[2]})
+            self.memory.put(key, entry)
+        return {**entry[1], 'depth': entry[0]}
+
+    def put(self, fen, engine, depth, evaluation):
+        """Stores `evaluation` unless a deeper one is already cached."""
+        if not evaluation:
+            return
+        key = (self.get_position_key(fen), engine)
+        entry = self.memory.peek(key)
+        if entry is not None and entry[0] >= depth:
+            return
+        evaluation = {'type': evaluation['type'], 'value': evaluation['value']}
+        self.memory.put(key, (depth, evaluation))
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO evaluations (position, engine, depth, type, value) '
+                'VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (position, engine) DO UPDATE SET '
+                'depth = excluded.depth, type = excluded.type, value = excluded.value '
+                'WHERE excluded.depth > evaluations.depth',
+                (*key, depth, evaluation['type'], evaluation['value']),
+            )
+            self.connection.commit()
+
+    def get_stats(self):
+        with self.lock:
+            stored = self.connection.execute(
+                'SELECT COUNT(*) FROM evaluations').fetchone()[0]
+            return {
+                'memory': self.memory.get_stats(),
+                'disk_entries': stored,
+                'disk_hits': self.disk_hits,
+                'disk_misses': self.disk_misses,
+            }
+
+
+if __name__ == '__main__':
+    cache = EvaluationCache.build(':memory:')
+    fen = 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1'
+    cache.put(fen, 'stockfish-15', 12, {'type': 'cp', 'value': 35})
+    print(cache.get(fen, 'stockfish-15', 10))
+    print(cache.get(fen, 'stockfish-15', 14))
+    print(cache.get_stats())
@@ -0,0 +1,140 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread safe in-process LRU cache bounded by entry count and/or bytes.
+
+    Entry sizes come from `sizeof(value)` (sys.getsizeof by default) and are
+    only tracked when `max_bytes` is set. With a `ttl` (seconds, also settable
+    per entry) entries expire and read as missing; expiry times are wall clock
+    times so `items` can be saved and put back in another process. Hit, miss,
+    eviction and expiration counters are available through `get_stats`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.max_entries = kwargs.get('max_entries')
+        self.max_bytes = kwargs.get('max_bytes')
+        self.sizeof = kwargs.get('sizeof', sys.getsizeof)
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.ttl = kwargs.get('ttl')
+        # key -> time.time() after which the entry is gone
+        self.expires = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def build(max_entries=None, max_bytes=None, sizeof=sys.getsizeof, ttl=None):
+        if not max_entries and not max_bytes:
+            raise ValueError('max_entries or max_bytes is required')
+        return LRUCache(max_entries=max_entries, max_bytes=max_bytes, sizeof=sizeof, ttl=ttl)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries and not self._expire(key)
+
+    def get(self, key, default=None, accept=None):
+        """Returns an entry, or `default` when it is missing or `accept(value)`
+        is false; either counts as a miss."""
+        with self.lock:
+            if key not in self.entries or self._expire(key) or (
+                    accept is not None and not accept(self.entries[key])):
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def peek(self, key, default=None):
+        """Returns an entry without counting a lookup or refreshing it."""
+        with self.lock:
+            if key not in self.entries or self._expire(key):
+                return default
+            return self.entries[key]
+
+    def put(self, key, value, ttl=None):
+        """Stores `value`, expiring after `ttl` seconds (the cache's by default)."""
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = value
+            ttl = ttl if ttl is not None else self.ttl
+            if ttl is not None:
+                self.expires[key] = time.time() + ttl
+            if self.max_bytes:
+                size = self.sizeof(value)
+                self.sizes[key] = size
+                self.current_bytes += size
+            while self.entries and self._is_full():
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries[key]
+            self._remove(key)
+            return value
+
+    def items(self):
+        """(key, value, expiry time or None) of every live entry, least
+        recently used first."""
+        with self.lock:
+            now = time.time()
+            return [
+                (key, value, self.expires.get(key))
+                for key, value in self.entries.items()
+                if self.expires.get(key, now + 1) > now
+            ]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.expires.clear()
+            self.current_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0,
+            }
+
+    def _is_full(self):
+        if self.max_entries and len(self.entries) > self.max_entries:
+            return True
+        return bool(self.max_bytes) and self.current_bytes > self.max_bytes
+
+    def _expire(self, key):
+        # Called with the lock held; removes the entry if it has expired
+        expires = self.expires.get(key)
+        if expires is None or expires > time.time():
+            return False
+        self._remove(key)
+        self.expirations += 1
+        return True
+
+    def _remove(self, key):
+        del self.entries[key]
+        self.expires.pop(key, None)
+        self.current_bytes -= self.sizes.pop(key, 0)
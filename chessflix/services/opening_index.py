@@ -0,0 +1,227 @@
+import argparse
+import os
+from collections import Counter
+
+import chess
+import chess.polyglot
+import numpy as np
+
+from chessflix.services.pgn_reader import read_moves
+from chessflix.services.radar_context import RAW_FEATURES
+
+
+class OpeningIndex:
+    """Precomputed evaluations and raw radar features of common opening
+    positions, keyed by their polyglot zobrist hash.
+
+    The table is kept as sorted numpy arrays (one row per position) and
+    saved as a single compressed .npz file, so a lookup is one binary search.
+    Evaluations are only served to the engine version the index was built
+    with and when they were searched at least as deep as requested; the raw
+    radar features do not depend on the engine and are always served.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.keys = kwargs.get('keys', np.zeros(0, dtype=np.uint64))
+        self.depths = kwargs.get('depths', np.zeros(0, dtype=np.int16))
+        # True where the value is a mate distance instead of centipawns
+        self.mates = kwargs.get('mates', np.zeros(0, dtype=bool))
+        self.values = kwargs.get('values', np.zeros(0, dtype=np.int32))
+        self.raw_features = kwargs.get(
+            'raw_features', np.zeros((0, len(RAW_FEATURES), 2)))
+        self.engine_version = kwargs.get('engine_version')
+        # Deepest ply indexed; later positions are not looked up at all
+        self.max_ply = kwargs.get('max_ply', 0)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def build(path='opening_index.npz'):
+        """Loads the index saved at `path`, or an empty one when there is none.
+
+        Args:
+            path (string): .npz file written by `save`
+
+        Returns:
+            OpeningIndex: Opening index
+        """
+        if not os.path.exists(path):
+            return OpeningIndex()
+        data = np.load(path)
+        return OpeningIndex(
+            keys=data['keys'],
+            depths=data['depths'],
+            mates=data['mates'],
+            values=data['values'],
+            raw_features=data['raw_features'],
+            engine_version=str(data['engine_version']),
+            max_ply=int(data['max_ply']),
+        )
+
+    def save(self, path):
+        """Writes the index to `path`, replacing it in one step."""
+        tmp_file = f'{path}.tmp.npz'
+        np.savez_compressed(
+            tmp_file,
+            keys=self.keys,
+            depths=self.depths,
+            mates=self.mates,
+            values=self.values,
+            raw_features=self.raw_features,
+            engine_version=np.str_(self.engine_version or ''),
+            max_ply=self.max_ply,
+        )
+        os.replace(tmp_file, path)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, key):
+        """Row of the position with zobrist hash `key`, or None."""
+        i = int(np.searchsorted(self.keys, np.uint64(key)))
+        if i < len(self.keys) and self.keys[i] == key:
+            self.hits += 1
+            return i
+        self.misses += 1
+        return None
+
+    def get_evaluation(self, position, engine_version, depth):
+        """Stored evaluation ({'type', 'value', 'depth'}) of a fen or board,
+        or None when it is missing, shallower than `depth` or was searched by
+        another engine version."""
+        if not len(self.keys) or engine_version != self.engine_version:
+            return None
+        board = chess.Board(position) if isinstance(position, str) else position
+        if board.ply() > self.max_ply:
+            return None
+        i = self.find(chess.polyglot.zobrist_hash(board))
+        if i is None or self.depths[i] < depth:
+            return None
+        return {
+            'type': 'mate' if self.mates[i] else 'cp',
+            'value': int(self.values[i]),
+            'depth': int(self.depths[i]),
+        }
+
+    def get_raw_features(self, board, key=None):
+        """Raw radar scores of `board`, or None. `key` is its zobrist hash
+        when the caller already has it."""
+        if not len(self.keys) or board.ply() > self.max_ply:
+            return None
+        i = self.find(chess.polyglot.zobrist_hash(board) if key is None else key)
+        return None if i is None else self.raw_features[i]
+
+    def get_stats(self):
+        return {
+            'positions': len(self.keys),
+            'engine_version': self.engine_version,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    @staticmethod
+    def get_opening_positions(pgn_games, max_ply=20, min_games=2):
+        """Positions reached in the first `max_ply` plies of at least
+        `min_games` of `pgn_games`, most common first.
+
+        Returns:
+            list: (zobrist hash, fen) of every position
+        """
+        counts = Counter()
+        fens = {}
+        for pgn_game in pgn_games:
+            headers, board, moves = read_moves(pgn_game)
+            if headers.get('Variant', ''):
+                continue
+            seen = set()
+            for move in moves[:max_ply]:
+                board.push(move)
+                key = chess.polyglot.zobrist_hash(board)
+                # Transpositions within a game count once
+                if key not in seen:
+                    seen.add(key)
+                    counts[key] += 1
+                    fens.setdefault(key, board.fen())
+        return [(key, fens[key]) for key, count in counts.most_common() if count >= min_games]
+
+    @staticmethod
+    def generate(pgn_games, stockfish_service, radar_service, max_ply=20, min_games=2, depth=None, workers=None):
+        """Builds an index of the opening positions of `pgn_games`.
+
+        Args:
+            pgn_games (list): PGN strings, e.g. from ChessDotComService
+            stockfish_service (StockfishService): Engines to evaluate with
+            radar_service (RadarService): Raw radar feature calculator
+            max_ply (int): Plies from the start of each game to index
+            min_games (int): Games a position must appear in
+            depth (int): Search depth, defaults to the pool's
+            workers (int): Engines to use, defaults to all of the pool
+
+        Returns:
+            OpeningIndex: Opening index
+        """
+        from chessflix.services.stockfish_service import BATCH
+        positions = OpeningIndex.get_opening_positions(pgn_games, max_ply, min_games)
+        fens = [fen for _, fen in positions]
+        evaluations = stockfish_service.get_evaluations(
+            fens,
+            workers=workers or len(stockfish_service.engines),
+            depth=depth,
+            priority=BATCH)
+        rows = [
+            (key, evaluation)
+            for (key, _), evaluation in zip(positions, evaluations)
+            if evaluation
+        ]
+        rows.sort(key=lambda row: row[0])
+        keys = np.array([key for key, _ in rows], dtype=np.uint64)
+        fens = {key: fen for key, fen in positions}
+        return OpeningIndex(
+            keys=keys,
+            depths=np.array([e['depth'] for _, e in rows], dtype=np.int16),
+            mates=np.array([e['type'] == 'mate' for _, e in rows], dtype=bool),
+            values=np.array([e['value'] for _, e in rows], dtype=np.int32),
+            raw_features=radar_service.get_raw_features_batch(
+                [fens[key] for key, _ in rows]).reshape(len(rows), len(RAW_FEATURES), 2),
+            engine_version=stockfish_service.engine_version,
+            max_ply=max(
+                (chess.Board(fens[key]).ply() for key, _ in rows), default=0),
+        )
+
+
+if __name__ == '__main__':
+    from chessflix.services.chess_dot_com_service import ChessDotComService
+    from chessflix.services.radar_service import RadarService
+    from chessflix.services.stockfish_service import StockfishService
+
+    parser = argparse.ArgumentParser(
+        description='Builds the opening index from chess.com games')
+    parser.add_argument('usernames', nargs='+')
+    parser.add_argument('--limit', type=int, default=1000,
+                        help='games fetched per user')
+    parser.add_argument('--max-ply', type=int, default=20)
+    parser.add_argument('--min-games', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=None)
+    parser.add_argument('--stockfish', default='/opt/homebrew/bin/stockfish')
+    parser.add_argument('--output', default='opening_index.npz')
+    parser.add_argument('--archive-cache', default='archive_cache.db',
+                        help='SQLite file chess.com archives are cached in')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use archives already cached')
+    args = parser.parse_args()
+
+    chessdotcom_service = ChessDotComService.build(
+        archive_cache_file=args.archive_cache, offline=args.offline)
+    pgn_games = []
+    for username in args.usernames:
+        pgn_games.extend(chessdotcom_service.get_games_by_username(
+            username, get_pgns=True, limit=args.limit))
+    opening_index = OpeningIndex.generate(
+        pgn_games,
+        StockfishService.build(path=args.stockfish),
+        RadarService(normalize_scores=False),
+        max_ply=args.max_ply,
+        min_games=args.min_games,
+        depth=args.depth)
+    opening_index.save(args.output)
+    print(f'{len(opening_index)} positions from {len(pgn_games)} games -> {args.output}')
@@ -0,0 +1,83 @@
+"""Lean PGN decoding for bulk processing. Only the header tags and the
+mainline moves are read: comments (clock times included), variations, NAGs,
+move numbers and results are skipped without building a game tree, and moves
+come back as chess.Move objects played from the starting board, so nothing
+needs a FEN round trip. `chess.pgn.read_game` stays the reference for
+anything that needs the full game.
+"""
+import re
+
+import chess
+
+
+# The tag pattern of chess.pgn, whose values keep any escapes as written
+HEADER_RE = re.compile(r'\[([A-Za-z0-9][A-Za-z0-9_+#=:-]*)\s+"([^\r]*)"\]\s*$')
+# Comments, variation brackets, NAGs, results and move numbers are matched
+# first so whatever is left is a SAN token
+TOKEN_RE = re.compile(
+    r'\{[^}]*\}|;[^\n]*|[()]|\$\d+|1-0|0-1|1/2-1/2|\*|\d+\.+|[^\s(){};$]+')
+RESULTS = {'1-0', '0-1', '1/2-1/2', '*'}
+
+
+def read_headers(pgn):
+    """Tags of the header section of `pgn`.
+
+    Args:
+        pgn (string): A single PGN game
+
+    Returns:
+        tuple: (dict of tag -> value, offset where the movetext starts)
+    """
+    headers = {}
+    offset = 0
+    length = len(pgn)
+    while offset < length:
+        end = pgn.find('\n', offset)
+        end = length if end == -1 else end + 1
+        line = pgn[offset:end].strip()
+        if line and not line.startswith('['):
+            break
+        match = HEADER_RE.match(line)
+        if match:
+            headers[match.group(1)] = match.group(2)
+        offset = end
+    return headers, offset
+
+
+def iter_sans(movetext):
+    """Yields the SAN of every mainline move of `movetext`."""
+    depth = 0
+    for token in TOKEN_RE.findall(movetext):
+        first = token[0]
+        if first == '(':
+            depth += 1
+        elif first == ')':
+            depth = max(0, depth - 1)
+        elif depth or first in '{;$' or token in RESULTS or token[-1] == '.' or token.isdigit():
+            continue
+        else:
+            yield token.rstrip('!?')
+
+
+def read_moves(pgn):
+    """Decodes the mainline of a PGN game. Like `chess.pgn.read_game`, the
+    moves stop at the first illegal or unreadable one.
+
+    Args:
+        pgn (string): A single PGN game
+
+    Returns:
+        tuple: (headers dict, starting chess.Board, list of chess.Move)
+    """
+    headers, offset = read_headers(pgn)
+    fen = headers.get('FEN')
+    board = chess.Board(fen) if fen else chess.Board()
+    start = board.copy(stack=False)
+    moves = []
+    for san in iter_sans(pgn[offset:]):
+        try:
+            moves.append(board.push_san(san))
+        except ValueError:
+            break
+    return headers, start, moves
+
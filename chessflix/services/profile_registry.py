@@ -0,0 +1,114 @@
+import glob
+import os
+import threading
+import time
+
+from chessflix.services.radar_profile import RadarProfile
+
+
+class ProfileRegistry:
+    """Every trained_stats_*.json profile in a directory, compiled once and
+    indexed by username, game count and date.
+
+    Lookups read a single prebuilt dict, so selecting a profile per request is
+    O(1) for any combination of the three keys. `refresh` recompiles only the
+    files whose mtime changed and swaps in a whole new index at the end, so
+    requests that are already running keep the index they started with.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.directory = kwargs.get('directory', '.')
+        self.pattern = kwargs.get('pattern', 'trained_stats_*.json')
+        # path -> (mtime, RadarProfile)
+        self.files = {}
+        # (username, game_count, date), any of them None -> best RadarProfile
+        self.index = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    @staticmethod
+    def build(directory='.', watch_interval=None):
+        registry = ProfileRegistry(directory=directory)
+        registry.refresh()
+        if watch_interval:
+            registry.watch(watch_interval)
+        return registry
+
+    def get(self, username=None, game_count=None, date=None):
+        """Returns the profile matching every given key. When several match,
+        the most recent date wins, then the largest game count.
+
+        Args:
+            username (string): Chess.com username (case insensitive)
+            game_count (int): Number of games the profile was trained on
+            date (string): Training date, YYYY-MM-DD
+
+        Returns:
+            RadarProfile: Matching profile or None
+        """
+        if username:
+            username = username.lower()
+        if game_count:
+            game_count = int(game_count)
+        return self.index.get((username or None, game_count or None, date or None))
+
+    def list_profiles(self):
+        return [
+            {
+                'username': profile.username,
+                'game_count': profile.game_count,
+                'date': profile.date,
+            }
+            for _, profile in sorted(self.files.values(), key=lambda f: f[1].path)
+        ]
+
+    def refresh(self):
+        """Reloads new or modified profile files and drops deleted ones."""
+        with self.lock:
+            files = {}
+            for path in glob.glob(os.path.join(self.directory, self.pattern)):
+                try:
+                    mtime = os.path.getmtime(path)
+                    loaded = self.files.get(path)
+                    if loaded and loaded[0] == mtime:
+                        files[path] = loaded
+                    else:
+                        files[path] = (mtime, RadarProfile.load(path))
+                except Exception as e:
+                    # Keep serving the previous version of a file that is
+                    # mid-write or invalid
+                    print(f'Error loading profile {path}:', e)
+                    if path in self.files:
+                        files[path] = self.files[path]
+            index = {}
+            for _, profile in files.values():
+                username = (profile.username or '').lower() or None
+                for key in self._keys(username, profile.game_count, profile.date):
+                    best = index.get(key)
+                    if best is None or self._rank(profile) > self._rank(best):
+                        index[key] = profile
+            # Swap in one step so concurrent lookups never see a partial index
+            self.files = files
+            self.index = index
+
+    def watch(self, interval=5):
+        """Refreshes the registry every `interval` seconds on a daemon thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        self.watcher = threading.Thread(target=run, daemon=True)
+        self.watcher.start()
+
+    @staticmethod
+    def _keys(username, game_count, date):
+        return [
+            (u, c, d)
+            for u in (username, None)
+            for c in (game_count, None)
+            for d in (date, None)
+        ]
+
+    @staticmethod
+    def _rank(profile):
+        return (profile.date or '', profile.game_count or 0, profile.path)
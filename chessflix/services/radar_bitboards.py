@@ -0,0 +1,164 @@
+"""Integer bitboard versions of the cheap radar features. Every function takes a
+chess.Board and returns the raw (white, black) scores of the matching
+`RadarService.calculate_*` method, bit for bit (including int vs float), which
+tests/test_radar_bitboards.py checks on a fixed corpus of games and FENs.
+"""
+import chess
+
+
+CENTRAL_SQUARES = [chess.E4, chess.D4, chess.E5, chess.D5]
+WHITE_KINGSIDE_SQUARES = [
+    chess.E1, chess.G1, chess.F1, chess.H1, chess.E2, chess.G2, chess.F2, chess.H2]
+BLACK_KINGSIDE_SQUARES = [
+    chess.E8, chess.G8, chess.F8, chess.H8, chess.E7, chess.G7, chess.F7, chess.H7]
+WHITE_QUEENSIDE_SQUARES = [
+    chess.D1, chess.C1, chess.B1, chess.A1, chess.D2, chess.C2, chess.B2, chess.A2]
+BLACK_QUEENSIDE_SQUARES = [
+    chess.D8, chess.C8, chess.B8, chess.A8, chess.D7, chess.C7, chess.B7, chess.A7]
+
+
+def _squares_mask(squares):
+    mask = 0
+    for square in squares:
+        mask |= chess.BB_SQUARES[square]
+    return mask
+
+
+BB_CENTER = _squares_mask(CENTRAL_SQUARES)
+BB_WHITE_KINGSIDE = _squares_mask(WHITE_KINGSIDE_SQUARES)
+BB_BLACK_KINGSIDE = _squares_mask(BLACK_KINGSIDE_SQUARES)
+BB_WHITE_QUEENSIDE = _squares_mask(WHITE_QUEENSIDE_SQUARES)
+BB_BLACK_QUEENSIDE = _squares_mask(BLACK_QUEENSIDE_SQUARES)
+# Every square the central control and flank attack features read
+BB_ZONES = (BB_CENTER | BB_WHITE_KINGSIDE | BB_BLACK_KINGSIDE |
+            BB_WHITE_QUEENSIDE | BB_BLACK_QUEENSIDE)
+
+
+def _backward_probes(color):
+    """For each square, the mask of squares the reference implementation probes
+    for a supporting pawn (None when the pawn cannot be backward). The probes
+    replicate its raw `chess.square(file + d, rank +/- 1)` arithmetic, so edge
+    files wrap onto the neighbouring rank and a-file probes below rank 1 index
+    BB_SQUARES[-1] (h8)."""
+    probes = []
+    step = 8 if color == chess.WHITE else -8
+    for square in chess.SQUARES:
+        rank = chess.square_rank(square)
+        if (color == chess.WHITE and rank >= 7) or (color == chess.BLACK and rank <= 0):
+            probes.append(None)
+            continue
+        mask = 0
+        for d in (-1, 0, 1):
+            probe = square + step + d
+            if probe < 64:
+                mask |= chess.BB_SQUARES[probe]
+        probes.append(mask)
+    return probes
+
+
+BACKWARD_PROBES = [_backward_probes(chess.BLACK), _backward_probes(chess.WHITE)]
+
+
+def pawn_attacks(pawns, color):
+    if color == chess.WHITE:
+        return (((pawns & ~chess.BB_FILE_A) << 7) |
+                ((pawns & ~chess.BB_FILE_H) << 9)) & chess.BB_ALL
+    return ((pawns & ~chess.BB_FILE_A) >> 9) | ((pawns & ~chess.BB_FILE_H) >> 7)
+
+
+def attacked_squares(board, color):
+    """Union of every square attacked by `color`."""
+    mask = pawn_attacks(board.pieces_mask(chess.PAWN, color), color)
+    for square in chess.scan_forward(board.occupied_co[color] & ~board.pawns):
+        mask |= board.attacks_mask(square)
+    return mask
+
+
+def weight_of(board, mask):
+    """Total material weight (pawn 1 ... queen 9, king 0) of the pieces in `mask`."""
+    return (chess.popcount(mask & board.pawns) +
+            3 * chess.popcount(mask & (board.knights | board.bishops)) +
+            5 * chess.popcount(mask & board.rooks) +
+            9 * chess.popcount(mask & board.queens))
+
+
+def calculate_space(board, attacked=None):
+    """`attacked` optionally holds the precomputed attacked_squares() of
+    [black, white], as kept by RadarContext."""
+    if attacked is None:
+        attacked = [attacked_squares(board, chess.BLACK),
+                    attacked_squares(board, chess.WHITE)]
+    # A square counts for white when black attacks it and vice versa,
+    # mirroring RadarService.calculate_space.
+    return (chess.popcount(attacked[chess.BLACK]),
+            chess.popcount(attacked[chess.WHITE]))
+
+
+def calculate_material_balance(board):
+    return (weight_of(board, board.occupied_co[chess.WHITE]),
+            weight_of(board, board.occupied_co[chess.BLACK]))
+
+
+def _pawn_structure_score(pawns, color):
+    score = 0
+    probes = BACKWARD_PROBES[color]
+    for square in chess.scan_forward(pawns):
+        pawn_score = 10
+        # A pawn alone on its file counts as isolated, otherwise as doubled
+        if pawns & chess.BB_FILES[square & 7] & ~chess.BB_SQUARES[square]:
+            pawn_score -= 1
+        else:
+            pawn_score -= 2
+        probe = probes[square]
+        if probe is not None and not pawns & probe:
+            pawn_score -= 1
+        score += pawn_score
+    return score
+
+
+def calculate_pawn_structure_health(board):
+    return (_pawn_structure_score(board.pieces_mask(chess.PAWN, chess.WHITE), chess.WHITE),
+            _pawn_structure_score(board.pieces_mask(chess.PAWN, chess.BLACK), chess.BLACK))
+
+
+def square_pressure(board, squares_mask, color, attacked=None, pressure=None):
+    """Weighted attacks by `color` on the squares of `squares_mask`, halved where
+    the opponent also covers the square. The reference adds weight / 2 per
+    defended attacker, so the result is a float as soon as one exists.
+    `pressure` optionally holds the weight of `color`'s attackers of every
+    square, as kept by PieceTerms."""
+    if attacked is None:
+        attacked = [attacked_squares(board, chess.BLACK),
+                    attacked_squares(board, chess.WHITE)]
+    undefended = 0
+    defended = 0
+    has_defended = False
+    for square in chess.scan_forward(squares_mask & attacked[color]):
+        if pressure is None:
+            weight = weight_of(board, board.attackers_mask(color, square))
+        else:
+            weight = pressure[square]
+        if attacked[not color] & chess.BB_SQUARES[square]:
+            defended += weight
+            has_defended = True
+        else:
+            undefended += weight
+    if has_defended:
+        return undefended + defended / 2
+    return undefended
+
+
+def calculate_central_control(board, attacked=None, pressure=(None, None)):
+    """`pressure` optionally holds the attacker weights of [black, white]."""
+    return (square_pressure(board, BB_CENTER, chess.WHITE, attacked, pressure[chess.WHITE]),
+            square_pressure(board, BB_CENTER, chess.BLACK, attacked, pressure[chess.BLACK]))
+
+
+def calculate_kingside_attack(board, attacked=None, pressure=(None, None)):
+    return (square_pressure(board, BB_BLACK_KINGSIDE, chess.WHITE, attacked, pressure[chess.WHITE]),
+            square_pressure(board, BB_WHITE_KINGSIDE, chess.BLACK, attacked, pressure[chess.BLACK]))
+
+
+def calculate_queenside_attack(board, attacked=None, pressure=(None, None)):
+    return (square_pressure(board, BB_BLACK_QUEENSIDE, chess.WHITE, attacked, pressure[chess.WHITE]),
+            square_pressure(board, BB_WHITE_QUEENSIDE, chess.BLACK, attacked, pressure[chess.BLACK]))
@@ -0,0 +1,368 @@
+import chess
+
+from chessflix.services import radar_bitboards
+from chessflix.services.radar_bitboards import (
+    BLACK_KINGSIDE_SQUARES,
+    BLACK_QUEENSIDE_SQUARES,
+    WHITE_KINGSIDE_SQUARES,
+    WHITE_QUEENSIDE_SQUARES,
+)
+
+
+WEIGHTS = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9
+}
+MOBILITY_WEIGHTS = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9,
+    chess.KING: 0
+}
+MAX_POTENTIAL = {
+    chess.PAWN: 3,
+    chess.KNIGHT: 8,
+    chess.BISHOP: 13,
+    chess.ROOK: 14,
+    chess.QUEEN: 27
+}
+# Features returned to clients, in response order
+RADAR_FEATURES = [
+    'space',
+    'piece_mobility',
+    'pawn_structure_health',
+    'king_safety',
+    'attacked_pieces',
+    'tactical_opps',
+    'material_balance',
+    'central_control',
+    'kingside_attack',
+    'queenside_attack',
+    'strong_threats',
+    'checks_captures_threats',
+]
+# Raw (un-normalized) scores everything in RADAR_FEATURES is derived from.
+# 'king_flank' holds KING_FLANK_CODES of the white and black king.
+RAW_FEATURES = [
+    'space',
+    'piece_mobility',
+    'pawn_structure_health',
+    'attacked_pieces',
+    'material_balance',
+    'central_control',
+    'kingside_attack',
+    'queenside_attack',
+    'strong_threats',
+    'forks',
+    'checks_captures_threats',
+    'king_flank',
+]
+KING_FLANK_CODES = {None: 0, 'kingside': 1, 'queenside': 2}
+
+
+# What each piece adds to its side's scores, see PieceTerms.get_terms
+PIECE_TERMS = [
+    'mobility',
+    'attacked_pieces',
+    'strong_threats',
+    'forks',
+    'checks',
+    'captures',
+    'threats',
+]
+(MOBILITY, ATTACKED_PIECES, STRONG_THREATS, FORKS,
+ CHECKS, CAPTURES, THREATS) = range(len(PIECE_TERMS))
+
+
+class PieceTerms:
+    """What every piece of a position adds to its side's PIECE_TERMS scores,
+    and their per-side totals.
+
+    `update` moves the state to another position and only recomputes the
+    pieces whose terms may differ: the ones on changed squares, the ones whose
+    attack set changed, and the ones attacking a square whose occupant or
+    defenders changed. Every term but mobility is a whole or half number, so
+    the totals are kept up to date exactly by adding and subtracting; the
+    mobility floats are summed afresh in square order, like the reference.
+    The weight of each side's attackers of the central and flank squares is
+    kept up to date the same way.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # square -> (color, attack mask, terms) of the piece on it
+        self.entries = kwargs.get('entries', {})
+        # totals[color][term]; the mobility entry is not used
+        self.totals = kwargs.get('totals', [[0] * len(PIECE_TERMS), [0] * len(PIECE_TERMS)])
+        # Occupied squares and attacked[color] masks of the last position
+        self.occupied = kwargs.get('occupied', 0)
+        self.attacked = kwargs.get('attacked', [0, 0])
+        # pressure[color][square] -> weight of the `color` pieces attacking
+        # `square`, for the squares of radar_bitboards.BB_ZONES
+        self.pressure = kwargs.get('pressure') or [[0] * 64, [0] * 64]
+
+    def update(self, board, piece_map, attacks, attacked, changed=chess.BB_ALL):
+        """Moves the terms to `board`. `changed` holds the squares whose
+        occupant changed since the last update."""
+        entries = self.entries
+        for square in chess.scan_forward(self.occupied & changed):
+            self._subtract(entries.pop(square))
+        # A piece's targets or their defenders may differ where these changed
+        dirty = [changed | (attacked[color] ^ self.attacked[color]) for color in (chess.BLACK, chess.WHITE)]
+        occupied_co = board.occupied_co
+        for square, piece in piece_map.items():
+            attack_mask = attacks[square]
+            enemy = not piece.color
+            entry = entries.get(square)
+            if entry is not None and entry[1] == attack_mask and not attack_mask & dirty[enemy]:
+                continue
+            target_mask = attack_mask & occupied_co[enemy]
+            # A target is defended when its own side attacks its square
+            terms = self.get_terms(
+                piece_map, piece, attack_mask, target_mask, target_mask & attacked[enemy])
+            if entry is None or entry[1] != attack_mask:
+                if entry is not None:
+                    self._subtract(entry)
+                entry = (piece.color, attack_mask, terms)
+                self._add(entry)
+            elif terms != entry[2]:
+                # Same squares attacked, so the attacker weights stay
+                totals = self.totals[piece.color]
+                totals[:] = [total - old + new for total, old, new in zip(totals, entry[2], terms)]
+                entry = (piece.color, attack_mask, terms)
+            entries[square] = entry
+        self.occupied = board.occupied
+        self.attacked = attacked
+
+    def _add(self, entry, sign=1):
+        color, attack_mask, terms = entry
+        totals = self.totals[color]
+        totals[:] = [total + sign * term for total, term in zip(totals, terms)]
+        pressure = self.pressure[color]
+        weight = sign * terms[CHECKS]
+        for square in chess.scan_forward(attack_mask & radar_bitboards.BB_ZONES):
+            pressure[square] += weight
+
+    def _subtract(self, entry):
+        self._add(entry, -1)
+
+    def get_totals(self, piece_map):
+        """([white], [black]) totals of every term. Mobility is added up in
+        square order like `RadarService.calculate_piece_mobility`."""
+        mobility = [0, 0]
+        for square, piece in piece_map.items():
+            mobility[piece.color] += self.entries[square][2][MOBILITY]
+        white = list(self.totals[chess.WHITE])
+        black = list(self.totals[chess.BLACK])
+        white[MOBILITY] = mobility[chess.WHITE]
+        black[MOBILITY] = mobility[chess.BLACK]
+        return white, black
+
+    @staticmethod
+    def get_terms(piece_map, piece, attack_mask, target_mask, defended_mask):
+        """What one piece adds to each of its side's PIECE_TERMS scores."""
+        piece_type = piece.piece_type
+        max_potential_squares = MAX_POTENTIAL.get(piece_type, 0)
+        mobility = chess.popcount(attack_mask) * MOBILITY_WEIGHTS.get(piece_type, 0) / \
+            max_potential_squares if max_potential_squares > 0 else 0
+        attacker_weight = WEIGHTS.get(piece_type, 0)
+        attacked_pieces = 0
+        strong_threats = 0
+        fork = 0
+        for i, target in enumerate(chess.scan_forward(target_mask)):
+            defended = bool(defended_mask & chess.BB_SQUARES[target])
+            attacked_weight = WEIGHTS.get(piece_map[target].piece_type, 0)
+            if attacked_weight >= attacker_weight or not defended:
+                attacked_pieces += attacked_weight
+            if piece_type == chess.KING:
+                continue
+            if attacker_weight > attacked_weight:
+                strong_threats += attacked_weight / 2 if defended else attacked_weight
+            # Only the second enemy target (in square order) scores the fork
+            if i == 1:
+                fork = attacked_weight / 2 if defended else attacked_weight
+        # Checks count the material of a side in check, kings weigh nothing
+        return (
+            mobility,
+            attacked_pieces,
+            strong_threats,
+            fork,
+            attacker_weight,
+            attacker_weight if target_mask else 0,
+            attacker_weight if attack_mask else 0,
+        )
+
+
+class RadarContext:
+    """Per-position state shared by every radar feature. The board is parsed
+    once and the piece map, the attack set of every piece and the squares
+    attacked by each colour are built up front, together with what every
+    piece adds to the piece based scores (PieceTerms). Each feature is then a
+    cheap sum over precomputed data instead of a fresh scan of the board.
+
+    Every `calculate_*` method returns the raw (white, black) scores that the
+    matching `RadarService.calculate_*` method feeds into `calculate_final_score`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.board = kwargs.get('board')
+        # square -> chess.Piece, in ascending square order
+        self.piece_map = kwargs.get('piece_map', {})
+        # square -> attack mask of the piece on that square
+        self.attacks = kwargs.get('attacks', {})
+        # attacked[color] -> mask of every square `color` attacks
+        self.attacked = kwargs.get('attacked', [0, 0])
+        # Terms of every piece, up to date for this position
+        self.piece_terms = kwargs.get('piece_terms')
+        # ([white], [black]) totals of the piece terms
+        self.piece_totals = None
+        # feature -> raw scores carried over (e.g. by IncrementalRadar) or
+        # memoized by the calculate_* methods below
+        self.scores = kwargs.get('scores', {})
+
+    @staticmethod
+    def build(board):
+        if isinstance(board, str):
+            board = chess.Board(board)
+        piece_map = {}
+        attacks = {}
+        for square in chess.scan_forward(board.occupied):
+            piece_map[square] = board.piece_at(square)
+            attacks[square] = board.attacks_mask(square)
+        return RadarContext.from_attacks(board, piece_map, attacks)
+
+    @staticmethod
+    def from_attacks(board, piece_map, attacks, piece_terms=None, changed=chess.BB_ALL, **kwargs):
+        """Builds a context from an already known piece map (ascending square
+        order) and per-piece attack masks. Extra kwargs are passed through, e.g.
+        already known raw `scores`.
+
+        `piece_terms` of an earlier position are updated in place, see
+        `PieceTerms.update`; `changed` holds the squares whose occupant changed
+        since that position.
+        """
+        attacked = [0, 0]
+        for square, piece in piece_map.items():
+            attacked[piece.color] |= attacks[square]
+        if piece_terms is None:
+            piece_terms = PieceTerms()
+        piece_terms.update(board, piece_map, attacks, attacked, changed)
+        return RadarContext(
+            board=board,
+            piece_map=piece_map,
+            attacks=attacks,
+            attacked=attacked,
+            piece_terms=piece_terms,
+            **kwargs,
+        )
+
+    def _sum_terms(self, index):
+        if self.piece_totals is None:
+            self.piece_totals = self.piece_terms.get_totals(self.piece_map)
+        white, black = self.piece_totals
+        return white[index], black[index]
+
+    def king_flanks(self):
+        """Returns the flank ('kingside', 'queenside' or None) each king sits on."""
+        white_king_sqr = self.board.king(chess.WHITE)
+        black_king_sqr = self.board.king(chess.BLACK)
+        white_flank = None
+        black_flank = None
+        if white_king_sqr in WHITE_KINGSIDE_SQUARES:
+            white_flank = 'kingside'
+        elif white_king_sqr in WHITE_QUEENSIDE_SQUARES:
+            white_flank = 'queenside'
+        if black_king_sqr in BLACK_KINGSIDE_SQUARES:
+            black_flank = 'kingside'
+        elif black_king_sqr in BLACK_QUEENSIDE_SQUARES:
+            black_flank = 'queenside'
+        return white_flank, black_flank
+
+    def calculate_raw_features(self):
+        """Returns the raw (white, black) scores for every entry of RAW_FEATURES."""
+        white_flank, black_flank = self.king_flanks()
+        return [
+            self.calculate_space(),
+            self.calculate_piece_mobility(),
+            self.calculate_pawn_structure_health(),
+            self.calculate_attacked_pieces(),
+            self.calculate_material_balance(),
+            self.calculate_central_control(),
+            self.calculate_kingside_attack(),
+            self.calculate_queenside_attack(),
+            self.calculate_strong_threats(),
+            self.calculate_forks(),
+            self.calculate_checks_captures_threats(),
+            (KING_FLANK_CODES[white_flank], KING_FLANK_CODES[black_flank]),
+        ]
+
+    def calculate_space(self):
+        return radar_bitboards.calculate_space(self.board, self.attacked)
+
+    def calculate_piece_mobility(self):
+        white_mobility, black_mobility = self._sum_terms(MOBILITY)
+        return round(white_mobility, 6), round(black_mobility, 6)
+
+    def _memoized(self, feature, calculate, *args):
+        scores = self.scores.get(feature)
+        if scores is None:
+            scores = calculate(self.board, *args)
+            self.scores[feature] = scores
+        return scores
+
+    def calculate_pawn_structure_health(self):
+        return self._memoized(
+            'pawn_structure_health', radar_bitboards.calculate_pawn_structure_health)
+
+    def calculate_attacked_pieces(self):
+        return self._sum_terms(ATTACKED_PIECES)
+
+    def calculate_material_balance(self):
+        return self._memoized(
+            'material_balance', radar_bitboards.calculate_material_balance)
+
+    def calculate_central_control(self):
+        return radar_bitboards.calculate_central_control(
+            self.board, self.attacked, self.piece_terms.pressure)
+
+    def calculate_kingside_attack(self):
+        return radar_bitboards.calculate_kingside_attack(
+            self.board, self.attacked, self.piece_terms.pressure)
+
+    def calculate_queenside_attack(self):
+        return radar_bitboards.calculate_queenside_attack(
+            self.board, self.attacked, self.piece_terms.pressure)
+
+    def calculate_checks_captures_threats(self):
+        white_checks, black_checks = self._sum_terms(CHECKS) if self.board.is_check() else (0, 0)
+        white_captures, black_captures = self._sum_terms(CAPTURES)
+        white_threats, black_threats = self._sum_terms(THREATS)
+        total_checks = (white_checks + black_checks)
+        total_captures = (white_captures + black_captures)
+        total_threats = (white_threats + black_threats)
+        white_checks_score = white_checks / \
+            total_checks if total_checks > 0 else 0
+        white_captures_score = white_captures / \
+            total_captures if total_captures > 0 else 0
+        white_threats_score = white_threats / \
+            total_threats if total_threats > 0 else 0
+        black_checks_score = black_checks / \
+            total_checks if total_checks > 0 else 0
+        black_captures_score = black_captures / \
+            total_captures if total_captures > 0 else 0
+        black_threats_score = black_threats / \
+            total_threats if total_threats > 0 else 0
+        return (
+            sum([white_checks_score, white_captures_score, white_threats_score]),
+            sum([black_checks_score, black_captures_score, black_threats_score]),
+        )
+
+    def calculate_strong_threats(self):
+        return self._sum_terms(STRONG_THREATS)
+
+    def calculate_forks(self):
+        return self._sum_terms(FORKS)
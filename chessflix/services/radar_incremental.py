@@ -0,0 +1,119 @@
+import chess
+import numpy as np
+
+from chessflix.services.radar_context import RAW_FEATURES, RadarContext
+
+
+class IncrementalRadar:
+    """Keeps the radar state of a position up to date along a move sequence.
+
+    After each move only what the move touched is recomputed: the attack masks
+    of the pieces on changed squares and of the sliders whose rays ran through
+    them, the PieceTerms of the pieces whose attacks, targets or defended
+    targets changed (which also keeps the central and flank attacker weights),
+    material on captures and promotions, and pawn structure only when a pawn
+    moved, was captured or promoted. Everything else is carried over from the
+    previous position. `RadarContext.build` on the same board is the
+    reference; anything that does not look like a single move (more squares
+    changed than castling touches) falls back to a full recompute.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.board = kwargs.get('board')
+        self.piece_map = kwargs.get('piece_map', {})
+        self.attacks = kwargs.get('attacks', {})
+        # PieceTerms of the last position a context was built for
+        self.piece_terms = kwargs.get('piece_terms')
+        # Squares whose occupant changed since the piece terms were updated
+        self.changed = kwargs.get('changed', chess.BB_ALL)
+        # feature -> raw scores still valid for the current position
+        self.scores = kwargs.get('scores', {})
+
+    @staticmethod
+    def build(board):
+        if isinstance(board, str):
+            board = chess.Board(board)
+        radar = IncrementalRadar(board=board.copy(stack=False))
+        radar.recompute()
+        return radar
+
+    def recompute(self):
+        context = RadarContext.build(self.board)
+        self.piece_map = context.piece_map
+        self.attacks = context.attacks
+        self.piece_terms = context.piece_terms
+        self.changed = 0
+        self.scores = {}
+
+    def push(self, move):
+        """Plays `move` (chess.Move or uci string) and updates the state."""
+        board = self.board
+        if isinstance(move, str):
+            move = chess.Move.from_uci(move)
+        before = self._placement()
+        is_capture = board.is_capture(move)
+        board.push(move)
+        after = self._placement()
+        changed = 0
+        for old_mask, new_mask in zip(before, after):
+            changed |= old_mask ^ new_mask
+        if chess.popcount(changed) > 4:
+            self.recompute()
+            return
+        self.changed |= changed
+        attacks = self.attacks
+        # Sliders see through the changed squares, so their rays may have grown
+        # or shrunk; every other piece only changes if it moved.
+        sliders = (board.bishops | board.rooks | board.queens) & ~changed
+        for square in chess.scan_forward(sliders):
+            if attacks[square] & changed:
+                attacks[square] = board.attacks_mask(square)
+        piece_map = self.piece_map
+        for square in chess.scan_forward(changed):
+            attacks.pop(square, None)
+            piece = board.piece_at(square)
+            if piece is None:
+                piece_map.pop(square, None)
+            else:
+                attacks[square] = board.attacks_mask(square)
+                piece_map[square] = piece
+        # Features walk the piece map in ascending square order
+        self.piece_map = dict(sorted(piece_map.items()))
+        scores = self.scores
+        if is_capture or move.promotion:
+            scores.pop('material_balance', None)
+        if before[chess.PAWN - 1] != after[chess.PAWN - 1]:
+            scores.pop('pawn_structure_health', None)
+
+    def _placement(self):
+        board = self.board
+        return (board.pawns, board.knights, board.bishops, board.rooks,
+                board.queens, board.kings, board.occupied_co[chess.WHITE])
+
+    def context(self):
+        """RadarContext of the current position. Carried over scores are reused
+        and the ones it computes are kept for the following moves."""
+        context = RadarContext.from_attacks(
+            self.board,
+            self.piece_map,
+            dict(self.attacks),
+            piece_terms=self.piece_terms,
+            changed=self.changed,
+            scores=self.scores,
+        )
+        self.changed = 0
+        return context
+
+    def calculate_raw_features(self):
+        return self.context().calculate_raw_features()
+
+
+def calculate_raw_features_by_moves(start, moves):
+    """Raw scores of every position reached along `moves`. Module level so a
+    segment of a game can be scored in a ProcessPoolExecutor worker."""
+    raw = np.zeros((len(moves), len(RAW_FEATURES), 2))
+    radar = IncrementalRadar.build(start)
+    for i, move in enumerate(moves):
+        radar.push(move)
+        raw[i] = radar.calculate_raw_features()
+    return raw
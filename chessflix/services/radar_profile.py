@@ -0,0 +1,92 @@
+import json
+import os
+import re
+import numpy as np
+
+from chessflix.services.radar_context import RADAR_FEATURES
+
+
+DATE_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+
+class RadarProfile:
+    """Trained stats compiled for normalization: mean and standard deviation
+    arrays indexed by the position of each feature in RADAR_FEATURES. The
+    stats are validated once when the profile is built, so scaling a score is
+    plain array arithmetic."""
+
+    feature_index = {attr: i for i, attr in enumerate(RADAR_FEATURES)}
+
+    def __init__(self, *args, **kwargs):
+        self.username = kwargs.get('username')
+        self.game_count = kwargs.get('game_count')
+        # Training date (YYYY-MM-DD) and file, when loaded from disk
+        self.date = kwargs.get('date')
+        self.path = kwargs.get('path')
+        self.trained_stats = kwargs.get('trained_stats', {})
+        self.mean = kwargs.get('mean')
+        self.std_dev = kwargs.get('std_dev')
+
+    @staticmethod
+    def build(trained_stats):
+        """Compiles the contents of a trained_stats_*.json file.
+
+        Args:
+            trained_stats (dict): {'username', 'game_count', 'trained_stats'}
+
+        Returns:
+            RadarProfile: Compiled profile
+        """
+        stats = trained_stats.get('trained_stats') or {}
+        mean = np.zeros(len(RADAR_FEATURES))
+        std_dev = np.zeros(len(RADAR_FEATURES))
+        for i, attr in enumerate(RADAR_FEATURES):
+            attr_stats = stats.get(attr, {})
+            if not attr_stats.get('std_dev') or not attr_stats.get('mean'):
+                raise Exception(
+                    f'Standard Deviation and Mean are required for {attr}')
+            mean[i] = attr_stats.get('mean')
+            std_dev[i] = attr_stats.get('std_dev')
+        return RadarProfile(
+            username=trained_stats.get('username'),
+            game_count=trained_stats.get('game_count'),
+            trained_stats=trained_stats,
+            mean=mean,
+            std_dev=std_dev,
+        )
+
+    @staticmethod
+    def load(stats_file):
+        f = open(stats_file, 'r')
+        trained_stats = json.load(f)
+        f.close()
+        profile = RadarProfile.build(trained_stats)
+        profile.path = stats_file
+        match = DATE_PATTERN.search(os.path.basename(stats_file))
+        profile.date = match.group(1) if match else None
+        return profile
+
+    def scale(self, scores, features):
+        """z-scores `scores` with the stats of `features` and rescales them to
+        0-10, matching RadarService.calculate_final_score.
+
+        Args:
+            scores (np.ndarray): Shape (N, len(features), 2)
+            features (list): Feature name whose stats apply to each column
+
+        Returns:
+            np.ndarray: Scaled scores, same shape as `scores`
+        """
+        index = [self.feature_index[attr] for attr in features]
+        mean = self.mean[index][:, None]
+        std_dev = self.std_dev[index][:, None]
+        # Same operation order as calc_z_score and rescale_value (-3..3 -> 0..10)
+        rescaled = np.minimum(((scores - mean) / std_dev - -3) * (10 - 0) / (3 - -3) + 0, 10)
+        # Python's round, as np.round rounds some halves the other way
+        return np.array(
+            [round(value, 4) for value in rescaled.ravel().tolist()]).reshape(rescaled.shape)
+
+    def get_stats(self, attr):
+        """Returns the (mean, std_dev) of a feature."""
+        i = self.feature_index[attr]
+        return self.mean[i].item(), self.std_dev[i].item()
@@ -1,15 +1,30 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 from datetime import datetime
+import itertools
+import multiprocessing
 import numpy as np
 import json
-import io
+import os
 import chess
-import chess.pgn
-import statistics
+import chess.polyglot
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 
 from chessflix.services.stockfish_service import StockfishService
 from chessflix.services.chess_dot_com_service import ChessDotComService
+from chessflix.services.lru_cache import LRUCache
+from chessflix.services.radar_incremental import (
+    IncrementalRadar,
+    calculate_raw_features_by_moves,
+)
+from chessflix.services.radar_profile import RadarProfile
+from chessflix.services.radar_training import TrainingAggregate, train_games
+from chessflix.services.radar_context import (
+    KING_FLANK_CODES,
+    RADAR_FEATURES,
+    RAW_FEATURES,
+    RadarContext,
+)
 
 
 class RadarService:
@@ -32,21 +47,78 @@ class RadarService:
             'checks_captures_threats'
         ]
         self.trained_stats = kwargs.get('trained_stats', {})
+        self.profile = kwargs.get('profile')
+        if self.profile is None and self.trained_stats:
+            self.profile = RadarProfile.build(self.trained_stats)
         self.normalize_scores = kwargs.get('normalize_scores', True)
+        # zobrist hash -> raw feature array. Raw scores do not depend on the
+        # trained stats, so entries stay valid when the profile changes.
+        self.feature_cache = kwargs.get('feature_cache')
+        # Precomputed raw scores of common opening positions
+        self.opening_index = kwargs.get('opening_index')
+        # Worker processes for long move sequences (see `start_workers`);
+        # without them every sequence is scored in this process
+        self.executor = kwargs.get('executor')
+        self.workers = kwargs.get('workers') or os.cpu_count()
 
     @staticmethod
-    def build(stockfish_service, stats_file, normalize_scores=True):
-        f = open(stats_file, 'r')
-        trained_stats = json.load(f)
-        f.close()
+    def build(stockfish_service, stats_file, normalize_scores=True, cache_size=100000, cache_bytes=None, workers=None, opening_index=None, executor=None, archive_cache_file=None):
+        profile = RadarProfile.load(stats_file)
+        feature_cache = None
+        if cache_size or cache_bytes:
+            feature_cache = LRUCache.build(
+                max_entries=cache_size,
+                max_bytes=cache_bytes,
+                sizeof=lambda raw: raw.nbytes,
+            )
         return RadarService(
             normalize_scores=normalize_scores,
-            trained_stats=trained_stats,
+            trained_stats=profile.trained_stats,
+            profile=profile,
             stockfish_service=stockfish_service,
-            chessdotcom_service=ChessDotComService.build(),
+            chessdotcom_service=ChessDotComService.build(
+                archive_cache_file=archive_cache_file),
+            feature_cache=feature_cache,
+            workers=workers,
+            opening_index=opening_index,
+            executor=executor,
         )
 
-    def get_features_by_fen(self, fen):
+    @staticmethod
+    def start_workers(workers=None):
+        """Starts the worker processes that score long move sequences.
+
+        The workers are forked from the calling process right away, so this
+        has to run at startup, before any service starts a thread (engine
+        supervisors, file watchers). Shut the pool down on exit.
+
+        Args:
+            workers (int): Worker processes, defaults to the cpu count
+
+        Returns:
+            ProcessPoolExecutor: Pool to build the RadarService with
+        """
+        executor = ProcessPoolExecutor(
+            max_workers=workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context('fork'))
+        # The first task forks every worker at once
+        executor.submit(int).result()
+        return executor
+
+    def get_features_by_fen(self, fen, shared_context=True):
+        """Calculates every radar feature for a position.
+
+        Args:
+            fen (string): Chess position fen
+            shared_context (bool): Parse the board once and derive every feature
+                from a shared RadarContext. When False each `calculate_*` method
+                parses the fen itself, which is slower but kept as the reference.
+
+        Returns:
+            dict: Scores for each feature
+        """
+        if shared_context:
+            return self.to_feature_dicts(self.get_features_batch([fen]))[0]
         features = {
             'space': self.calculate_space(fen),
             'piece_mobility': self.calculate_piece_mobility(fen),
@@ -63,6 +135,168 @@ class RadarService:
         }
         return features
 
+    def get_raw_features_batch(self, positions):
+        """Raw (un-normalized) scores for a batch of positions.
+
+        Args:
+            positions (list): Chess position fens or chess.Board objects
+
+        Returns:
+            np.ndarray: Shape (N, len(RAW_FEATURES), 2) of (white, black) scores
+        """
+        raw = np.zeros((len(positions), len(RAW_FEATURES), 2))
+        for i, position in enumerate(positions):
+            if isinstance(position, str):
+                position = chess.Board(position)
+            raw[i] = self.get_raw_features(
+                position, lambda: RadarContext.build(position))
+        return raw
+
+    def get_raw_features(self, board, build_context):
+        """Raw scores of one position, served from the opening index or the
+        feature cache when they are enabled. `build_context` is only called
+        when neither has the position."""
+        if self.feature_cache is None and self.opening_index is None:
+            return build_context().calculate_raw_features()
+        key = chess.polyglot.zobrist_hash(board)
+        if self.opening_index is not None:
+            raw = self.opening_index.get_raw_features(board, key)
+            if raw is not None:
+                return raw
+        if self.feature_cache is None:
+            return build_context().calculate_raw_features()
+        raw = self.feature_cache.get(key)
+        if raw is None:
+            raw = np.array(build_context().calculate_raw_features(), dtype=float)
+            self.feature_cache.put(key, raw)
+        return raw
+
+    def get_features_batch(self, positions, profile=None):
+        """Radar features for a batch of positions as one dense array. Use
+        `to_feature_dicts` to get the `get_features_by_fen` dictionaries back.
+
+        Args:
+            positions (list): Chess position fens or chess.Board objects
+            profile (RadarProfile): Normalization profile, defaults to the
+                service's own
+
+        Returns:
+            np.ndarray: Shape (N, len(RADAR_FEATURES), 2) of (white, black) scores
+        """
+        return self.normalize_batch(self.get_raw_features_batch(positions), profile)
+
+    def get_raw_features_by_moves(self, start, moves, workers=1, min_segment=40):
+        """Raw scores for every position reached along `moves`, updated
+        incrementally from one position to the next.
+
+        Args:
+            start (string|chess.Board): Starting position fen or board
+            moves (list): chess.Move objects or uci strings
+            workers (int): Split the moves into up to this many segments scored
+                in the worker processes, when the service has them; segments
+                skip the feature cache
+            min_segment (int): Fewest moves worth sending to a worker
+
+        Returns:
+            np.ndarray: Shape (len(moves), len(RAW_FEATURES), 2)
+        """
+        moves = list(moves)
+        segments = 1
+        if self.executor is not None:
+            segments = min(workers or 1, self.workers, len(moves) // min_segment)
+        if segments > 1:
+            return self.get_raw_features_by_segments(start, moves, segments)
+        raw = np.zeros((len(moves), len(RAW_FEATURES), 2))
+        for i, position in enumerate(self.iter_raw_features_by_moves(start, moves)):
+            raw[i] = position
+        return raw
+
+    def iter_raw_features_by_moves(self, start, moves):
+        """Yields the raw scores of each position along `moves` as soon as it
+        is reached."""
+        radar = IncrementalRadar.build(start)
+        for move in moves:
+            radar.push(move)
+            yield self.get_raw_features(radar.board, radar.context)
+
+    def get_raw_features_by_segments(self, start, moves, segments):
+        board = chess.Board(start) if isinstance(start, str) else start.copy(stack=False)
+        size = -(-len(moves) // segments)
+        starts = []
+        chunks = []
+        for i in range(0, len(moves), size):
+            starts.append(board.fen())
+            chunks.append([str(move) for move in moves[i:i + size]])
+            for move in chunks[-1]:
+                board.push_uci(move)
+        return np.concatenate(list(
+            self.executor.map(calculate_raw_features_by_moves, starts, chunks)))
+
+    def get_features_by_moves(self, start, moves, profile=None, workers=1):
+        """`get_features_batch` for the positions reached along `moves`."""
+        return self.normalize_batch(
+            self.get_raw_features_by_moves(start, moves, workers), profile)
+
+    def iter_features_by_moves(self, start, moves, profile=None):
+        """Yields the `get_features_by_moves` row of each position as soon as
+        it is reached."""
+        for raw in self.iter_raw_features_by_moves(start, moves):
+            yield self.normalize_batch(np.asarray(raw, dtype=float)[None], profile)[0]
+
+    def normalize_batch(self, raw, profile=None):
+        """Vectorized `calculate_final_score` over a raw feature batch, including
+        the king safety and tactical opportunity aggregates. `profile` overrides
+        the service's own normalization profile."""
+        if self.normalize_scores:
+            scale = (profile or self.get_profile()).scale
+        else:
+            def scale(scores, features):
+                return scores
+        raw_index = {attr: i for i, attr in enumerate(RAW_FEATURES)}
+        # Every raw feature but the king flanks is scaled on its own; forks
+        # use the tactical_opps stats, as in calculate_forks
+        features = RAW_FEATURES[:raw_index['king_flank']]
+        scaled = scale(
+            raw[:, :len(features)],
+            ['tactical_opps' if attr == 'forks' else attr for attr in features])
+        index = {attr: i for i, attr in enumerate(features)}
+        tactical_opps = (
+            scaled[:, index['strong_threats']] +
+            scaled[:, index['forks']] +
+            scaled[:, index['checks_captures_threats']]) / 3
+        # King safety of a side is the opponent's attack on the flank its king is on
+        flanks = raw[:, raw_index['king_flank']]
+        king_attack = np.zeros_like(flanks)
+        for flank, attr in (('kingside', 'kingside_attack'), ('queenside', 'queenside_attack')):
+            code = KING_FLANK_CODES[flank]
+            # white_score <- black's attack on the white king and vice versa
+            king_attack[:, 0] = np.where(
+                flanks[:, 0] == code, scaled[:, index[attr], 1], king_attack[:, 0])
+            king_attack[:, 1] = np.where(
+                flanks[:, 1] == code, scaled[:, index[attr], 0], king_attack[:, 1])
+        aggregates = scale(
+            np.stack([tactical_opps, king_attack], axis=1),
+            ['tactical_opps', 'king_safety'])
+        index.update({'tactical_opps': len(features), 'king_safety': len(features) + 1})
+        scaled = np.concatenate([scaled, aggregates], axis=1)
+        return scaled[:, [index[attr] for attr in RADAR_FEATURES]]
+
+    @staticmethod
+    def to_feature_dicts(features):
+        """Dictionary view of a `get_features_batch` array, one dict per position
+        shaped like `get_features_by_fen`."""
+        return [
+            {
+                attr: {
+                    'attribute': attr,
+                    'white_score': scores[0],
+                    'black_score': scores[1],
+                }
+                for attr, scores in zip(RADAR_FEATURES, position)
+            }
+            for position in features.tolist()
+        ]
+
     def calculate_piece_mobility(self, fen):
         board = chess.Board(fen)
         weights = {
@@ -739,64 +973,116 @@ class RadarService:
         # Show the plot
         plt.show()
 
-    def train_stats_by_username(self, username='MagnusCarlsen', limit=100):
+    def train_stats_by_username(self, username='MagnusCarlsen', limit=100, parallel=False, workers=None, chunk_size=10, checkpoint_file=None):
         """Train the model by calculating the standard deviation and mean for each attribute
         based on a players games.
 
         Args:
             username (string): The Chess.com username of the player to train the model with
+            parallel (bool): Extract features in a pool of worker processes
+            workers (int): Worker process count, defaults to the number of cores
+            chunk_size (int): Games handed to a worker at a time; the stats do
+                not depend on it
+            checkpoint_file (string): Saves progress after every chunk and resumes
+                an interrupted run of the same username and limit after the
+                last trained game, so games played in between are not picked up
 
         Returns:
             dict: Stats for each attribute
         """
-        pgn_games = self.chessdotcom_service.get_games_by_username(
-            username, get_pgns=True, limit=limit)
-        attribute_scores = {f: [] for f in self.features}
-        with tqdm(total=len(pgn_games), desc='PGNs', leave=False) as pbar_1:
-            for pgn_game in pgn_games:
-                game = chess.pgn.read_game(io.StringIO(pgn_game))
-                headers = dict(game.headers)
-                if headers.get('Variant', ''):
-                    continue
-                board = game.board()
-                with tqdm(total=len(list(game.mainline_moves())), desc='FEN features', leave=False) as pbar_2:
-                    for move in game.mainline_moves():
-                        board.push(move)
-                        fen = board.fen()
-                        if fen:
-                            features = self.get_features_by_fen(fen)
-                            # Iterate over each attribute and calculate results separately
-                            for attribute, scores in list(features.items()):
-                                attribute_scores[attribute].append(
-                                    scores.get('white_score'))
-                                attribute_scores[attribute].append(
-                                    scores.get('black_score'))
-                        pbar_2.update(1)
-                pbar_1.update(1)
-        # Calculate standard deviation and mean for each attribute
-        stats = {}
-        with tqdm(total=len(attribute_scores), desc='Stats', leave=False) as pbar_3:
-            for attribute, scores in attribute_scores.items():
-                stats[attribute] = {
-                    'std_dev': statistics.stdev(scores),
-                    'mean': statistics.mean(scores),
-                    'mode': statistics.mode(scores),
-                    'max': max(scores),
-                    'min': min(scores),
-                }
-            pbar_3.update(1)
-        self.trained_stats = stats
-        f = open(
-            f'trained_stats_{username}_{limit}_{format(datetime.now(), "%Y-%m-%d")}.json', 'w')
-        f.write(json.dumps({
+        run = {'username': username, 'limit': limit}
+        aggregate = TrainingAggregate.build()
+        start = 0
+        position = None
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            saved, metadata = TrainingAggregate.load(checkpoint_file)
+            if metadata.get('run') == run and metadata.get('position'):
+                aggregate, start = saved, metadata['pgn_count']
+                position = metadata['position']
+        # Games stream in while later archives are still downloading; chunks
+        # are trained as soon as they are full
+        pgn_games = self.chessdotcom_service.iter_positioned_games(
+            username, get_pgns=True, limit=None if limit is None else limit - start,
+            after=position)
+        chunks = iter(lambda: list(itertools.islice(pgn_games, chunk_size)), [])
+        profile = self.profile if self.normalize_scores else None
+        # Every game is merged on its own, in game order, so the result does not
+        # depend on the worker count or the chunk size; finished chunks wait
+        # here until the ones before them are in
+        finished = {}
+        sizes = {}
+        positions = {}
+        merged = 0
+
+        def merge_finished():
+            nonlocal merged, start, position
+            while merged in finished:
+                for game_aggregate in finished.pop(merged):
+                    aggregate.merge(game_aggregate)
+                start += sizes.pop(merged)
+                position = positions.pop(merged)
+                if checkpoint_file:
+                    aggregate.save(
+                        checkpoint_file, run=run, pgn_count=start, position=position)
+                merged += 1
+
+        with tqdm(total=limit, initial=start, desc='PGNs', leave=False) as pbar_1:
+            if parallel:
+                workers = workers or os.cpu_count()
+                # The archive downloads already run on threads, which a forked
+                # worker would inherit mid-request; spawned workers start clean
+                with ProcessPoolExecutor(
+                        max_workers=workers,
+                        mp_context=multiprocessing.get_context('spawn')) as executor:
+                    futures = {}
+
+                    def collect(done):
+                        for future in done:
+                            i = futures.pop(future)
+                            finished[i] = future.result()
+                            pbar_1.update(sizes[i])
+                            merge_finished()
+
+                    for i, chunk in enumerate(chunks):
+                        sizes[i] = len(chunk)
+                        positions[i] = chunk[-1][0]
+                        futures[executor.submit(
+                            train_games, [pgn for _, pgn in chunk],
+                            self.normalize_scores, profile)] = i
+                        # Only a couple of chunks per worker are queued, so
+                        # memory does not grow with the number of games
+                        if len(futures) >= 2 * workers:
+                            collect(wait(futures, return_when=FIRST_COMPLETED).done)
+                    collect(as_completed(list(futures)))
+            else:
+                for i, chunk in enumerate(chunks):
+                    sizes[i] = len(chunk)
+                    positions[i] = chunk[-1][0]
+                    finished[i] = train_games(
+                        [pgn for _, pgn in chunk], self.normalize_scores, profile)
+                    pbar_1.update(len(chunk))
+                    merge_finished()
+        stats = aggregate.get_stats()
+        self.trained_stats = {
             'username': username,
             'game_count': limit,
             'trained_stats': stats
-        }, indent=4))
+        }
+        f = open(
+            f'trained_stats_{username}_{limit}_{format(datetime.now(), "%Y-%m-%d")}.json', 'w')
+        f.write(json.dumps(self.trained_stats, indent=4))
         f.close()
+        self.profile = RadarProfile.build(self.trained_stats)
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
         print(stats)
         return stats
 
+    def get_profile(self):
+        if self.profile is None:
+            raise Exception('Standard Deviation and Mean are required')
+        return self.profile
+
     def calculate_final_score(self, input_scores):
         # Get Standard Deviation and Mean for each attribute
         if not self.normalize_scores:
@@ -804,14 +1090,7 @@ class RadarService:
         attr = input_scores.get('attribute', '')
         if not attr:
             raise Exception('Attribute is required')
-        if attr == 'pawn_structure_health':
-            print()
-        std_dev = self.trained_stats.get(
-            'trained_stats').get(attr, {}).get('std_dev')
-        mean = self.trained_stats.get(
-            'trained_stats').get(attr, {}).get('mean')
-        if not std_dev or not mean:
-            raise Exception('Standard Deviation and Mean are required')
+        mean, std_dev = self.get_profile().get_stats(attr)
         # Calculate z-scores
         white_z_score = self.calc_z_score(
             input_scores.get('white_score'), mean, std_dev)
@@ -862,7 +1141,8 @@ if __name__ == '__main__':
     radar = RadarService.build(
         stockfish_service,
         stats_file='trained_stats_MagnusCarlsen_1000_2023-06-26.json',
-        normalize_scores=False
+        normalize_scores=False,
+        archive_cache_file='archive_cache.db',
     )
     # create_radar_plot(features_white, features_black)
     # fen = '1r1q1r1k/1N4bp/8/2n1pp2/bpPp1P2/3P2PP/4N1BK/1R1Q1R2 w - - 0 23'
@@ -0,0 +1,201 @@
+import json
+import math
+import os
+from collections import Counter
+
+import numpy as np
+
+from chessflix.services.pgn_reader import read_moves
+from chessflix.services.radar_context import RADAR_FEATURES
+
+
+class TrainingAggregate:
+    """Mergeable, constant memory summary of the scores seen while training.
+
+    Per feature it keeps the count, mean and sum of squared deviations
+    (Welford, merged batch by batch with Chan's parallel update), the running
+    min and max, and a quantized value -> count histogram for the mode. Values
+    are rounded to `precision` decimal places before they are counted; a histogram that
+    grows past `max_bins` bins is coarsened one decimal place at a time, so
+    memory depends on the number of features and never on the number of
+    positions.
+
+    Floating point sums and histogram coarsening depend on the order and the
+    grouping of the merges, so only aggregates built the same way match bit
+    for bit: training builds one aggregate per game and merges them one at a
+    time in game order, whatever the chunking. The state can be saved to and
+    restored from a JSON checkpoint.
+    """
+
+    def __init__(self, *args, **kwargs):
+        size = len(RADAR_FEATURES)
+        self.count = kwargs.get('count', np.zeros(size, dtype=np.int64))
+        self.mean = kwargs.get('mean', np.zeros(size))
+        self.m2 = kwargs.get('m2', np.zeros(size))
+        self.min = kwargs.get('min', np.full(size, np.inf))
+        self.max = kwargs.get('max', np.full(size, -np.inf))
+        self.max_bins = kwargs.get('max_bins', 4096)
+        # Decimal places scores are first rounded to, and the current (possibly
+        # coarsened) places of each histogram
+        self.precision = kwargs.get('precision', 4)
+        self.decimals = kwargs.get('decimals') or [self.precision] * size
+        self.histograms = kwargs.get('histograms') or [Counter() for _ in range(size)]
+        self.games = kwargs.get('games', 0)
+        self.positions = kwargs.get('positions', 0)
+
+    @staticmethod
+    def build(decimals=4, max_bins=4096):
+        return TrainingAggregate(precision=decimals, max_bins=max_bins)
+
+    def add(self, features):
+        """Adds a `RadarService.get_features_batch` array of one game."""
+        if not len(features):
+            return
+        self.games += 1
+        self.positions += len(features)
+        # (feature, scores) with white and black scores interleaved per position
+        values = np.asarray(features, dtype=float).transpose(1, 0, 2).reshape(
+            len(RADAR_FEATURES), -1)
+        mean = values.mean(axis=1)
+        self._combine(
+            np.full(len(RADAR_FEATURES), values.shape[1], dtype=np.int64),
+            mean,
+            ((values - mean[:, None]) ** 2).sum(axis=1),
+            values.min(axis=1),
+            values.max(axis=1),
+        )
+        for i, histogram in enumerate(self.histograms):
+            rounded = Counter(np.round(values[i], self.precision).tolist())
+            histogram.update(
+                self._quantize(rounded, self.precision, self.decimals[i]))
+            self._bound(i)
+
+    def merge(self, other):
+        self.games += other.games
+        self.positions += other.positions
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        for i in range(len(self.histograms)):
+            decimals = min(self.decimals[i], other.decimals[i])
+            self._requantize(i, decimals)
+            self.histograms[i].update(
+                self._quantize(other.histograms[i], other.decimals[i], decimals))
+            self._bound(i)
+        return self
+
+    def get_stats(self):
+        stats = {}
+        for i, attribute in enumerate(RADAR_FEATURES):
+            if self.count[i] < 2:
+                raise Exception(f'At least two scores are required for {attribute}')
+            stats[attribute] = {
+                'std_dev': math.sqrt(self.m2[i] / (self.count[i] - 1)),
+                'mean': self.mean[i].item(),
+                'mode': self.histograms[i].most_common(1)[0][0],
+                'max': self.max[i].item(),
+                'min': self.min[i].item(),
+            }
+        return stats
+
+    def to_dict(self):
+        return {
+            'count': self.count.tolist(),
+            'mean': self.mean.tolist(),
+            'm2': self.m2.tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist(),
+            'max_bins': self.max_bins,
+            'precision': self.precision,
+            'decimals': list(self.decimals),
+            # JSON keys are strings, so keep the bins as [value, count] pairs
+            'histograms': [list(histogram.items()) for histogram in self.histograms],
+            'games': self.games,
+            'positions': self.positions,
+        }
+
+    @staticmethod
+    def from_dict(state):
+        return TrainingAggregate(
+            count=np.array(state['count'], dtype=np.int64),
+            mean=np.array(state['mean'], dtype=float),
+            m2=np.array(state['m2'], dtype=float),
+            min=np.array(state['min'], dtype=float),
+            max=np.array(state['max'], dtype=float),
+            max_bins=state['max_bins'],
+            precision=state['precision'],
+            decimals=list(state['decimals']),
+            histograms=[Counter(dict(map(tuple, bins))) for bins in state['histograms']],
+            games=state['games'],
+            positions=state['positions'],
+        )
+
+    def save(self, checkpoint_file, **metadata):
+        """Writes the aggregate and `metadata` to `checkpoint_file`. The file
+        is replaced in one step so an interrupted save keeps the previous one."""
+        tmp_file = f'{checkpoint_file}.tmp'
+        f = open(tmp_file, 'w')
+        f.write(json.dumps({**metadata, 'aggregate': self.to_dict()}))
+        f.close()
+        os.replace(tmp_file, checkpoint_file)
+
+    @staticmethod
+    def load(checkpoint_file):
+        """Returns the (aggregate, metadata) saved in `checkpoint_file`."""
+        f = open(checkpoint_file, 'r')
+        checkpoint = json.load(f)
+        f.close()
+        return TrainingAggregate.from_dict(checkpoint.pop('aggregate')), checkpoint
+
+    def _combine(self, count, mean, m2, low, high):
+        total = self.count + count
+        # Features without any score yet keep their zero state
+        safe_total = np.maximum(total, 1)
+        delta = mean - self.mean
+        self.mean = np.where(
+            self.count == 0, mean, self.mean + delta * count / safe_total)
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / safe_total
+        self.count = total
+        self.min = np.minimum(self.min, low)
+        self.max = np.maximum(self.max, high)
+
+    def _bound(self, i):
+        while len(self.histograms[i]) > self.max_bins:
+            self._requantize(i, self.decimals[i] - 1)
+
+    def _requantize(self, i, decimals):
+        if decimals < self.decimals[i]:
+            self.histograms[i] = self._quantize(
+                self.histograms[i], self.decimals[i], decimals)
+            self.decimals[i] = decimals
+
+    @staticmethod
+    def _quantize(histogram, current, decimals):
+        if decimals >= current:
+            return histogram
+        # One decimal place at a time, so every shard rounds a value the same way
+        for places in range(current - 1, decimals - 1, -1):
+            rounded = Counter()
+            for value, count in histogram.items():
+                rounded[float(np.round(value, places))] += count
+            histogram = rounded
+        return histogram
+
+
+def train_games(pgn_games, normalize_scores=False, profile=None):
+    """Computes a TrainingAggregate for every game of a chunk of PGNs. Module
+    level so it can run in a ProcessPoolExecutor worker.
+
+    Returns:
+        list: One aggregate per standard game with moves, in game order
+    """
+    from chessflix.services.radar_service import RadarService
+    radar_service = RadarService(normalize_scores=normalize_scores, profile=profile)
+    aggregates = []
+    for pgn_game in pgn_games:
+        headers, board, moves = read_moves(pgn_game)
+        if headers.get('Variant', ''):
+            continue
+        if moves:
+            aggregate = TrainingAggregate.build()
+            aggregate.add(radar_service.get_features_by_moves(board, moves))
+            aggregates.append(aggregate)
+    return aggregates
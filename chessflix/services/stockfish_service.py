@@ -1,51 +1,691 @@
+import os
 import threading
-from stockfish import Stockfish
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from stockfish import Stockfish, StockfishException
+
+
+# Priority classes of engine work. Interactive requests are served before
+# queued batch work, and batch work may only hold `batch_limit` engines.
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# Errors of an engine process that died or was killed mid-call
+ENGINE_ERRORS = (StockfishException, BrokenPipeError)
+
+
+class SupervisedStockfish(Stockfish):
+    """Stockfish that records since when a caller has been waiting for its
+    output, so a hung process can be told apart from a long search."""
+
+    def __init__(self, *args, start_timeout=None, **kwargs):
+        self.waiting_since = None
+        self.killed = False
+        # A process that does not come up in time is killed, so starting it fails
+        timer = threading.Timer(start_timeout, self.kill) if start_timeout else None
+        if timer is not None:
+            timer.start()
+        try:
+            super().__init__(*args, **kwargs)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def _read_line(self):
+        # A kill that came before the process was started, e.g. the start
+        # timeout firing while it was being launched, takes effect here
+        if self.killed:
+            self.kill()
+        self.waiting_since = time.monotonic()
+        try:
+            return super()._read_line()
+        finally:
+            self.waiting_since = None
+
+    def is_alive(self):
+        return hasattr(self, "_stockfish") and self._stockfish.poll() is None
+
+    def kill(self):
+        """Kills the process; a caller blocked reading from it gets a
+        StockfishException."""
+        self.killed = True
+        if self.is_alive():
+            self._stockfish.kill()
+            self._stockfish.wait()
 
 
 class StockfishService:
+    """Pool of Stockfish processes.
+
+    Callers check an engine out for the whole of a multi-step operation
+    (`with stockfish_service.checkout() as stockfish:`) so no two requests
+    ever drive the same process. Every engine gets its own Hash and Threads;
+    the pool size is capped so the engines together stay within the CPU and
+    memory budget. Waiting and checkout times are reported by `get_stats`.
+
+    Requests tagged with a session (a game being stepped through, a set of
+    previews) go back to the engine that served the session last, and keep
+    its hash: positions are set without `ucinewgame` while the engine has not
+    served anyone else in between. Sessions expire after `session_ttl`
+    seconds without a request.
+
+    Engine work is scheduled in two priority classes, INTERACTIVE and BATCH,
+    each with its own concurrency limit. Batch searches check their engine
+    back in after every position, so a long game never keeps interactive
+    requests waiting for more than one search.
+
+    Evaluations go through the optional OpeningIndex and EvaluationCache, so
+    opening positions and positions that were already searched deep enough
+    never reach an engine.
+
+    Engines are supervised (`supervise`): idle engines are probed with
+    `isready`, and an engine a caller has been waiting on for more than
+    `call_timeout` seconds is killed. Dead engines are replaced in the
+    background by a new process with the same options while requests queue
+    for the rest of the pool, and searches that lose their engine mid-call
+    are run again on another one (`run`).
+    """
+
     def __init__(self, *args, **kwargs):
-        self.fish = kwargs.get("stockfish")
-        self.lock = threading.Lock()
+        self.engines = kwargs.get("engines", [])
+        self.idle = list(self.engines)
+        # Binary and options replacement engines are started with
+        self.path = kwargs.get("path")
+        self.parameters = kwargs.get("parameters", {})
+        # Seconds an engine may keep a caller waiting for output, and to
+        # answer an idle `isready` probe, before it is considered hung
+        self.call_timeout = kwargs.get("call_timeout", 60)
+        self.probe_timeout = kwargs.get("probe_timeout", 5)
+        # Times a search that lost its engine is run again on another one
+        self.retries = kwargs.get("retries", 2)
+        # Engines to replace at checkin instead of returning them to the pool
+        self.retiring = set()
+        self.spawning = 0
+        self.supervisor = None
+        self.checkout_timeout = kwargs.get("checkout_timeout")
+        self.session_ttl = kwargs.get("session_ttl", 300)
+        # Seconds to wait for a busy session engine before taking another one
+        self.affinity_wait = kwargs.get("affinity_wait", 0.5)
+        # session id -> {"engine", "last_used"}
+        self.sessions = {}
+        # engine -> session id of the last request it served
+        self.engine_sessions = {}
+        self.depth = kwargs.get("depth", 10)
+        self.engine_version = kwargs.get("engine_version")
+        self.evaluation_cache = kwargs.get("evaluation_cache")
+        self.opening_index = kwargs.get("opening_index")
+        self.lock = threading.RLock()
+        self.available = threading.Condition(self.lock)
+        batch_limit = kwargs.get("batch_limit") or max(1, len(self.engines) - 1)
+        self.classes = {
+            priority: {
+                "limit": limit,
+                "queued": 0,
+                "in_use": 0,
+                "checkouts": 0,
+                "wait_time": 0.0,
+                "max_wait_time": 0.0,
+            }
+            for priority, limit in ((INTERACTIVE, len(self.engines)), (BATCH, batch_limit))
+        }
+        self.metrics = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "affinity_hits": 0,
+            "affinity_misses": 0,
+            "wait_time": 0.0,
+            "max_wait_time": 0.0,
+            "checkout_time": 0.0,
+            "max_checkout_time": 0.0,
+            "probes": 0,
+            "failed_probes": 0,
+            "hung": 0,
+            "restarts": 0,
+            "retries": 0,
+        }
+
+    @staticmethod
+    def build(path, pool_size=None, hash_size=256, threads=1, cpu_budget=None, memory_budget=2048, checkout_timeout=None, evaluation_cache=None, session_ttl=300, batch_limit=None, opening_index=None, call_timeout=60, probe_interval=5):
+        """Starts the engine processes and their supervisor.
+
+        Args:
+            path (string): Stockfish binary
+            pool_size (int): Engines to start, defaults to as many as the budgets allow
+            hash_size (int): Hash of each engine, in MB
+            threads (int): Search threads of each engine
+            cpu_budget (int): Threads all engines may use together, defaults to the core count
+            memory_budget (int): Hash all engines may use together, in MB
+            checkout_timeout (float): Seconds to wait for a free engine, None waits forever
+            evaluation_cache (EvaluationCache): Cache of previous evaluations
+            session_ttl (float): Seconds a session keeps its engine without requests
+            batch_limit (int): Engines batch work may hold at once, defaults to
+                all but one
+            opening_index (OpeningIndex): Precomputed opening evaluations
+            call_timeout (float): Seconds an engine may keep a caller waiting
+                for output before it is killed and replaced
+            probe_interval (float): Seconds between health checks, None
+                disables supervision
+
+        Returns:
+            StockfishService: Engine pool
+        """
+        pool_size = StockfishService.get_pool_size(
+            pool_size, hash_size, threads, cpu_budget, memory_budget)
+        parameters = {
+            "Hash": hash_size,
+            "Threads": threads,
+            "Minimum Thinking Time": 10,
+        }
+        engines = [
+            StockfishService.spawn_engine(path, parameters)
+            for _ in range(pool_size)
+        ]
+        stockfish_service = StockfishService(
+            engines=engines,
+            path=path,
+            parameters=parameters,
+            checkout_timeout=checkout_timeout,
+            call_timeout=call_timeout,
+            depth=10,
+            engine_version=f"stockfish-{engines[0].get_stockfish_major_version()}",
+            evaluation_cache=evaluation_cache,
+            session_ttl=session_ttl,
+            batch_limit=batch_limit,
+            opening_index=opening_index,
+        )
+        if probe_interval:
+            stockfish_service.supervise(probe_interval)
+        return stockfish_service
+
+    @staticmethod
+    def spawn_engine(path, parameters, timeout=None):
+        """Starts an engine process with `parameters` applied and ready,
+        failing if that takes more than `timeout` seconds."""
+        return SupervisedStockfish(
+            path=path, depth=10, parameters=parameters, start_timeout=timeout)
 
     @staticmethod
-    def build(path):
+    def get_pool_size(pool_size, hash_size, threads, cpu_budget=None, memory_budget=2048):
+        cpu_budget = cpu_budget or os.cpu_count() or 1
+        limit = max(1, min(cpu_budget // threads, memory_budget // hash_size))
+        return min(pool_size, limit) if pool_size else limit
+
+    @contextmanager
+    def checkout(self, timeout=None, session=None, priority=INTERACTIVE):
+        """Lends an engine until the `with` block exits.
+
+        Args:
+            timeout (float): Seconds to wait for a free engine, defaults to the pool's
+            session (string): Game or session id to keep on the same engine
+            priority (string): INTERACTIVE or BATCH
+
+        Returns:
+            Stockfish: Engine reserved for the caller
+        """
+        timeout = timeout if timeout is not None else self.checkout_timeout
+        requested = time.monotonic()
+        with self.available:
+            self._expire_sessions(requested)
+            fish, waited = self._take(session, requested, timeout, priority)
+            checked_out = time.monotonic()
+            self.metrics["checkouts"] += 1
+            self.metrics["waits"] += int(waited)
+            self._record("wait_time", checked_out - requested)
+            priority_class = self.classes[priority]
+            priority_class["in_use"] += 1
+            priority_class["checkouts"] += 1
+            priority_class["wait_time"] += checked_out - requested
+            priority_class["max_wait_time"] = max(
+                priority_class["max_wait_time"], checked_out - requested)
         try:
-            fish = Stockfish(
-                path=path,
-                depth=10,
-            )
-            fish.update_engine_parameters(
-                {
-                    "Hash": 2048,
-                    "Threads": 4,
-                    "Minimum Thinking Time": 10,
-                }
-            )
-            return StockfishService(stockfish=fish)
-        except Exception as e:
-            print(e)
+            yield fish
+        finally:
+            with self.available:
+                priority_class["in_use"] -= 1
+                self._record("checkout_time", time.monotonic() - checked_out)
+                if fish in self.retiring or not fish.is_alive():
+                    self._replace(fish)
+                else:
+                    self.engine_sessions[fish] = session
+                    if session is not None:
+                        self.sessions[session] = {"engine": fish, "last_used": time.monotonic()}
+                    self.idle.append(fish)
+                self.available.notify_all()
 
-    def get_stockfish(self):
-        return self.fish
+    def is_warm(self, fish, session):
+        """Whether the engine's hash still holds `session`'s previous searches."""
+        return session is not None and self.engine_sessions.get(fish) == session
 
-    def acquire_lock(self):
-        self.lock.acquire()
+    def get_stats(self):
+        with self.lock:
+            checkouts = self.metrics["checkouts"]
+            return {
+                **self.metrics,
+                "size": len(self.engines),
+                "idle": len(self.idle),
+                "spawning": self.spawning,
+                "sessions": len(self.sessions),
+                "classes": {
+                    priority: {
+                        **priority_class,
+                        "avg_wait_time": (priority_class["wait_time"] / priority_class["checkouts"]
+                                          if priority_class["checkouts"] else 0),
+                    }
+                    for priority, priority_class in self.classes.items()
+                },
+                "avg_wait_time": self.metrics["wait_time"] / checkouts if checkouts else 0,
+                "avg_checkout_time": self.metrics["checkout_time"] / checkouts if checkouts else 0,
+            }
 
-    def release_lock(self):
-        self.lock.release()
+    def _take(self, session, requested, timeout, priority):
+        bound = self.sessions.get(session) if session is not None else None
+        preferred = bound["engine"] if bound and self.is_warm(bound["engine"], session) else None
+        waited = False
+        self.classes[priority]["queued"] += 1
+        try:
+            while True:
+                now = time.monotonic()
+                allowed = self._can_take(priority)
+                if allowed and preferred is not None and preferred in self.idle:
+                    self.idle.remove(preferred)
+                    self.metrics["affinity_hits"] += 1
+                    return preferred, waited
+                affinity_expired = now >= requested + self.affinity_wait
+                if allowed and self.idle and (preferred is None or affinity_expired):
+                    if preferred is not None:
+                        self.metrics["affinity_misses"] += 1
+                    return self._take_idle(), waited
+                wait = None if timeout is None else requested + timeout - now
+                if wait is not None and wait <= 0:
+                    self.metrics["timeouts"] += 1
+                    raise Exception(f"No Stockfish engine available after {timeout}s")
+                if allowed and preferred is not None and self.idle:
+                    affinity_wait = requested + self.affinity_wait - now
+                    wait = affinity_wait if wait is None else min(wait, affinity_wait)
+                waited = True
+                self.available.wait(wait)
+        finally:
+            self.classes[priority]["queued"] -= 1
+            # Batch work held back by this request may go now
+            self.available.notify_all()
 
-    def get_top_moves(self, fen, n):
-        self.acquire_lock()
+    def _can_take(self, priority):
+        priority_class = self.classes[priority]
+        if priority_class["in_use"] >= priority_class["limit"]:
+            return False
+        return priority == INTERACTIVE or not self.classes[INTERACTIVE]["queued"]
+
+    def _take_idle(self):
+        # Keep engines warm for live sessions: prefer one no session is using,
+        # then the one whose session was used the longest time ago
+        live = {
+            info["engine"]: info["last_used"]
+            for session, info in self.sessions.items()
+            if self.is_warm(info["engine"], session)
+        }
+        free = [fish for fish in self.idle if fish not in live]
+        fish = free[-1] if free else min(self.idle, key=lambda engine: live[engine])
+        self.idle.remove(fish)
+        return fish
+
+    def _expire_sessions(self, now):
+        for session, info in list(self.sessions.items()):
+            if now - info["last_used"] > self.session_ttl:
+                del self.sessions[session]
+
+    def _record(self, metric, seconds):
+        with self.lock:
+            self.metrics[metric] += seconds
+            self.metrics[f"max_{metric}"] = max(self.metrics[f"max_{metric}"], seconds)
+
+    def supervise(self, interval=5):
+        """Checks the engines every `interval` seconds on a daemon thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                self.check_engines()
+        self.supervisor = threading.Thread(target=run, daemon=True)
+        self.supervisor.start()
+
+    def check_engines(self):
+        """Kills engines that kept a caller waiting for more than
+        `call_timeout` seconds (the caller's search is run again elsewhere),
+        then probes the idle engines one at a time and replaces the ones that
+        do not answer."""
+        now = time.monotonic()
+        with self.lock:
+            engines = [fish for fish in self.engines if fish not in self.idle]
+        for fish in engines:
+            waiting_since = fish.waiting_since
+            if waiting_since is not None and now - waiting_since > self.call_timeout:
+                with self.lock:
+                    self.metrics["hung"] += 1
+                fish.kill()
+        with self.lock:
+            engines = list(self.idle)
+        for fish in engines:
+            with self.lock:
+                if fish not in self.idle:
+                    continue
+                self.idle.remove(fish)
+            healthy = self.probe(fish)
+            with self.available:
+                self.metrics["probes"] += 1
+                if healthy and fish not in self.retiring:
+                    self.idle.append(fish)
+                else:
+                    self.metrics["failed_probes"] += int(not healthy)
+                    self._replace(fish)
+                self.available.notify_all()
+
+    def probe(self, fish):
+        """Whether the engine answers `isready` within `probe_timeout` seconds."""
+        if not fish.is_alive():
+            return False
+        timer = threading.Timer(self.probe_timeout, fish.kill)
+        timer.start()
         try:
-            self.fish.set_fen_position(fen)
-            top_moves = self.fish.get_top_moves(n)
+            fish._is_ready()
+        except ENGINE_ERRORS:
+            return False
         finally:
-            self.release_lock()
-        return top_moves
+            timer.cancel()
+        return fish.is_alive()
+
+    def restart(self):
+        """Replaces every engine with a new process. Idle engines are replaced
+        right away, checked out ones when they are checked back in."""
+        with self.available:
+            for fish in list(self.engines):
+                if fish in self.idle:
+                    self.idle.remove(fish)
+                    self._replace(fish)
+                else:
+                    self.retiring.add(fish)
+
+    def _replace(self, fish):
+        # Called with the lock held: forget the engine and its sessions, and
+        # start its replacement in the background
+        self.retiring.discard(fish)
+        self.engines.remove(fish)
+        self.engine_sessions.pop(fish, None)
+        for session, info in list(self.sessions.items()):
+            if info["engine"] is fish:
+                del self.sessions[session]
+        fish.kill()
+        self.metrics["restarts"] += 1
+        self.spawning += 1
+        threading.Thread(target=self._respawn, daemon=True).start()
+
+    def _respawn(self):
+        delay = 0.1
+        while True:
+            try:
+                fish = self.spawn_engine(self.path, self.parameters, self.call_timeout)
+                break
+            except Exception as error:
+                print("Failed to start Stockfish:", error)
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+        with self.available:
+            self.spawning -= 1
+            self.engines.append(fish)
+            self.idle.append(fish)
+            self.available.notify_all()
+
+    def run(self, operation, stockfish=None, session=None, priority=INTERACTIVE):
+        """Returns `operation(fish)` run on a checked out engine. When the
+        engine dies mid-call the operation is run again on another engine, up
+        to `retries` times; an engine held by the caller (`stockfish`) is not
+        replaced, so its errors are raised."""
+        attempts = 0
+        while True:
+            try:
+                with self.reuse_or_checkout(stockfish, session, priority) as fish:
+                    return operation(fish)
+            except ENGINE_ERRORS:
+                if stockfish is not None or attempts >= self.retries:
+                    raise
+                attempts += 1
+                with self.lock:
+                    self.metrics["retries"] += 1
+
+    @contextmanager
+    def reuse_or_checkout(self, stockfish=None, session=None, priority=INTERACTIVE):
+        """Yields `stockfish` when the caller already holds an engine,
+        otherwise checks one out."""
+        if stockfish is not None:
+            yield stockfish
+            return
+        with self.checkout(session=session, priority=priority) as fish:
+            yield fish
+
+    def end_session(self, session):
+        with self.lock:
+            self.sessions.pop(session, None)
+
+    def get_evaluations(self, fens, stockfish=None, new_game=True, workers=1, depth=None, budget=None, session=None, priority=INTERACTIVE):
+        """Evaluates positions, searching only the ones missing from the
+        opening index and the cache. An engine is only checked out (or
+        `stockfish` used) when one is needed.
+
+        Args:
+            fens (list): Positions to evaluate
+            stockfish (Stockfish): Engine already held by the caller
+            new_game (bool): Clear the engine hash before the first search
+            workers (int): Engines to spread the searches over, each one takes a
+                contiguous run of positions
+            depth (int): Search depth, defaults to the pool's. With a budget it
+                only caps the search when given, and cached results must reach
+                it (or the pool's depth)
+            budget (dict): Anytime search limits, any of 'movetime' (ms per
+                position), 'nodes' (per position) and 'deadline' (ms for all
+                of `fens`). The engine deepens iteratively and the deepest
+                completed iteration is returned when the budget runs out
+            session (string): Game or session id, see `checkout`
+            priority (string): INTERACTIVE or BATCH
+
+        Returns:
+            list: Evaluation ({'type', 'value', 'depth'}) of every position
+        """
+        if budget:
+            # Budgeted searches only stop at a depth the caller asked for; the
+            # deadline becomes the time every position must be done by
+            budget = {**budget, "depth": depth}
+            deadline = budget.pop("deadline", None)
+            if deadline:
+                budget["stop_at"] = time.monotonic() + deadline / 1000
+        depth = depth or self.depth
+        evaluations = [None] * len(fens)
+        missing = []
+        for i, fen in enumerate(fens):
+            if self.opening_index is not None:
+                evaluations[i] = self.opening_index.get_evaluation(
+                    fen, self.engine_version, depth)
+            if evaluations[i] is None and self.evaluation_cache is not None:
+                evaluations[i] = self.evaluation_cache.get(
+                    fen, self.engine_version, depth)
+            if evaluations[i] is None:
+                missing.append(i)
+        if not missing:
+            return evaluations
+        workers = 1 if stockfish is not None else min(
+            workers or 1, len(self.engines) or 1, len(missing))
+        size = -(-len(missing) // workers)
+        chunks = [missing[i:i + size] for i in range(0, len(missing), size)]
+
+        def search(chunk):
+            # Only one chunk can stay on the session's engine
+            chunk_session = session if chunk is chunks[0] else None
+            return self._search(
+                [fens[i] for i in chunk], stockfish, new_game, depth, budget,
+                chunk_session, priority)
+
+        if len(chunks) == 1:
+            results = [search(chunks[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+                results = list(executor.map(search, chunks))
+        for chunk, chunk_evaluations in zip(chunks, results):
+            for i, evaluation in zip(chunk, chunk_evaluations):
+                evaluations[i] = evaluation
+        return evaluations
+
+    def _search(self, fens, stockfish, new_game, depth, budget=None, session=None, priority=INTERACTIVE):
+        evaluations = []
+        if stockfish is None and priority == BATCH:
+            # Check the engine back in after every position so interactive
+            # requests can get in between; the session brings the next
+            # position back to the same, still warm, engine
+            token = session if session is not None else object()
+            try:
+                for i, fen in enumerate(fens):
+                    evaluations.append(self.run(
+                        lambda fish: self._search_position(
+                            fish, fen, new_game and i == 0 and not self.is_warm(fish, token),
+                            depth, budget, len(fens) - i),
+                        session=token,
+                        priority=BATCH))
+            finally:
+                if session is None:
+                    self.end_session(token)
+            return evaluations
+
+        def search(fish):
+            # A replacement engine picks up after the last finished position
+            first = new_game and not evaluations and not self.is_warm(fish, session)
+            while len(evaluations) < len(fens):
+                i = len(evaluations)
+                # Positions of one request are related, so keep the hash
+                evaluations.append(self._search_position(
+                    fish, fens[i], first and i == 0, depth, budget, len(fens) - i))
+
+        self.run(search, stockfish, session)
+        return evaluations
+
+    def _search_position(self, fish, fen, new_game, depth, budget, positions_left):
+        fish.set_fen_position(fen, send_ucinewgame_token=new_game)
+        if budget:
+            evaluation = self.search_anytime(
+                fish, fen, positions_left=positions_left, **budget)
+        else:
+            previous_depth = fish.depth
+            fish.set_depth(depth)
+            try:
+                evaluation = fish.get_evaluation()
+            finally:
+                fish.depth = previous_depth
+            if evaluation:
+                evaluation["depth"] = depth
+        if self.evaluation_cache is not None and evaluation:
+            self.evaluation_cache.put(
+                fen, self.engine_version, evaluation["depth"], evaluation)
+        return evaluation
+
+    def search_anytime(self, fish, fen, depth=None, positions_left=1, movetime=None, nodes=None, stop_at=None):
+        """Searches the engine's current position within a budget.
+
+        Args:
+            fish (Stockfish): Engine set to `fen`
+            fen (string): Position being searched
+            depth (int): Deepest iteration to run
+            positions_left (int): Positions, this one included, still sharing `stop_at`
+            movetime (int): Milliseconds for this position
+            nodes (int): Nodes for this position
+            stop_at (float): time.monotonic() by which every position must be done
+
+        Returns:
+            dict: {'type', 'value', 'depth'} of the deepest completed iteration
+        """
+        limits = {"depth": depth, "movetime": movetime, "nodes": nodes}
+        timer = None
+        if stop_at is not None:
+            # Even share of what is left of the deadline
+            share = max(0.001, (stop_at - time.monotonic()) / positions_left)
+            limits["movetime"] = max(1, int(min(movetime or share * 1000, share * 1000)))
+            # Stockfish stops on movetime; the timer only catches overruns
+            timer = threading.Timer(share + 0.05, fish._put, ["stop"])
+            timer.start()
+        sign = 1 if fen.split(" ")[1] == "w" else -1
+        evaluation = {}
+        try:
+            fish._put("go " + " ".join(
+                f"{limit} {int(value)}" for limit, value in limits.items() if value))
+            while True:
+                text = fish._read_line().split(" ")
+                if text[0] == "bestmove":
+                    break
+                # Bound scores come from iterations that did not complete
+                if (text[0] != "info" or "score" not in text or "depth" not in text
+                        or "lowerbound" in text or "upperbound" in text):
+                    continue
+                if "multipv" in text and text[text.index("multipv") + 1] != "1":
+                    continue
+                score = text.index("score")
+                evaluation = {
+                    "type": text[score + 1],
+                    "value": int(text[score + 2]) * sign,
+                    "depth": int(text[text.index("depth") + 1]),
+                }
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return evaluation
+
+    def get_evaluation(self, fen, stockfish=None, new_game=True, depth=None, budget=None, session=None, priority=INTERACTIVE):
+        return self.get_evaluations(
+            [fen], stockfish, new_game, depth=depth, budget=budget, session=session,
+            priority=priority)[0]
+
+    def get_principal_variations(self, fen, n, stockfish=None, new_game=True, session=None):
+        """Runs a single MultiPV search and returns every line in full.
+
+        Args:
+            fen (string): Position to search from
+            n (int): Lines to return
+            stockfish (Stockfish): Engine already held by the caller
+            new_game (bool): Clear the engine hash before searching
+            session (string): Game or session id, see `checkout`
+
+        Returns:
+            list: {'moves', 'type', 'value'} of each line, best first, with
+                the score from white's point of view
+        """
+        return self.run(
+            lambda fish: self._search_principal_variations(fish, fen, n, new_game, session),
+            stockfish,
+            session)
 
-    def get_game_by_pgn(self, pgn):
-        self.fish.reset_engine_parameters()
-        self.fish.set_
+    def _search_principal_variations(self, fish, fen, n, new_game, session):
+        sign = 1 if fen.split(" ")[1] == "w" else -1
+        lines = {}
+        new_game = new_game and not self.is_warm(fish, session)
+        multipv = fish._parameters["MultiPV"]
+        if n != multipv:
+            fish._set_option("MultiPV", n)
+        fish.set_fen_position(fen, send_ucinewgame_token=new_game)
+        fish._go()
+        while True:
+            text = fish._read_line().split(" ")
+            if text[0] == "bestmove":
+                break
+            # Bound scores come from iterations that did not complete
+            if (text[0] != "info" or "pv" not in text or "score" not in text
+                    or "lowerbound" in text or "upperbound" in text):
+                continue
+            # Later info lines of a line come from deeper iterations
+            line = int(text[text.index("multipv") + 1]) if "multipv" in text else 1
+            score = text.index("score")
+            lines[line] = {
+                "moves": text[text.index("pv") + 1:],
+                "type": text[score + 1],
+                "value": int(text[score + 2]) * sign,
+            }
+        if n != multipv:
+            fish._set_option("MultiPV", multipv)
+        return [lines[line] for line in sorted(lines)]
 
 
 if __name__ == "__main__":
@@ -53,8 +693,8 @@ if __name__ == "__main__":
         f = StockfishService.build(path="/opt/homebrew/bin/stockfish")
     except Exception as e:
         f = StockfishService.build(path="/usr/local/bin/stockfish")
-    f.acquire_lock()
-    f.fish.set_fen_position("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR")
-    top_moves = f.fish.get_top_moves(5)
+    with f.checkout() as fish:
+        fish.set_fen_position("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR")
+        top_moves = fish.get_top_moves(5)
     print(top_moves)
-    f.release_lock()
+    print(f.get_stats())
@@ -0,0 +1,185 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import chess
+import chess.pgn
+import pytest
+import requests
+
+from chessflix.services.stockfish_service import StockfishService
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+@pytest.fixture(scope='session')
+def corpus_games():
+    """(starting board, mainline moves) of every game of the fixed corpus:
+    a few classic games plus generated ones that reach sparse endgames,
+    castling, en passant and underpromotions."""
+    games = []
+    with open(os.path.join(DATA_DIR, 'radar_corpus.pgn')) as pgn_file:
+        while True:
+            game = chess.pgn.read_game(pgn_file)
+            if game is None:
+                break
+            games.append((game.board(), list(game.mainline_moves())))
+    return games
+
+
+@pytest.fixture(scope='session')
+def corpus_boards(corpus_games):
+    """Every position of the corpus games and of the hand picked FENs."""
+    boards = []
+    for board, moves in corpus_games:
+        board = board.copy()
+        for move in moves:
+            board.push(move)
+            boards.append(board.copy(stack=False))
+    with open(os.path.join(DATA_DIR, 'radar_positions.fen')) as fen_file:
+        boards.extend(chess.Board(line.strip()) for line in fen_file if line.strip())
+    return boards
+
+
+@pytest.fixture(scope='session')
+def corpus_pgns():
+    """PGN strings of the corpus games."""
+    pgns = []
+    with open(os.path.join(DATA_DIR, 'radar_corpus.pgn')) as pgn_file:
+        while True:
+            game = chess.pgn.read_game(pgn_file)
+            if game is None:
+                break
+            pgns.append(str(game))
+    return pgns
+
+
+class FakeResponse:
+    def __init__(self, data=None, status_code=200, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(data).encode()
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'{self.status_code} Error', response=self)
+
+
+class FakeSession:
+    """Stands in for the `requests.Session` of ChessDotComService. `responses`
+    maps a url to its JSON data, or to a callable returning a FakeResponse;
+    unknown urls are 404s. Every requested url is kept in `requested`."""
+
+    def __init__(self):
+        self.responses = {}
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None, timeout=None):
+        with self.lock:
+            self.requested.append(url)
+        response = self.responses.get(url)
+        if response is None:
+            return FakeResponse({}, 404)
+        if callable(response):
+            return response()
+        return FakeResponse(response)
+
+
+@pytest.fixture
+def fake_session():
+    return FakeSession()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requested.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failures = server.failures.get(self.path)
+            status = failures.pop(0) if failures else 200
+            data = server.responses.get(self.path)
+        time.sleep(server.delay)
+        if status == 200 and data is None:
+            status = 404
+        body = json.dumps(data if status == 200 else {}).encode()
+        # Out of flight before the client can see the response and send the
+        # next request
+        with server.lock:
+            server.in_flight -= 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubChessCom(ThreadingHTTPServer):
+    """Local HTTP stand-in for api.chess.com. `responses` maps a path to its
+    JSON data, `failures` a path to the statuses of its next responses
+    (e.g. [429, 503]), and every request waits `delay` seconds. Requested
+    paths and the most requests ever in flight at once are recorded."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.url = f'http://127.0.0.1:{self.server_port}'
+        self.responses = {}
+        self.failures = {}
+        self.delay = 0
+        self.requested = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+
+@pytest.fixture
+def chess_com_server():
+    server = StubChessCom()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_stockfish(tmp_path):
+    """Path of an executable running tests/fake_stockfish.py."""
+    path = tmp_path / 'stockfish'
+    path.write_text(
+        f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(os.path.dirname(__file__), "fake_stockfish.py")}"\n')
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def engine_pool(fake_stockfish):
+    """Builds StockfishService pools of fake engines, killed after the test."""
+    services = []
+
+    def build(size=2, **kwargs):
+        engines = [StockfishService.spawn_engine(fake_stockfish, {}) for _ in range(size)]
+        service = StockfishService(
+            engines=engines, path=fake_stockfish, parameters={}, **kwargs)
+        services.append(service)
+        return service
+
+    yield build
+    for service in services:
+        with service.lock:
+            engines = list(service.engines)
+        for fish in engines:
+            fish.kill()
@@ -0,0 +1,55 @@
+"""Minimal UCI engine standing in for Stockfish in the pool tests. It answers
+just what the stockfish package and StockfishService send, with a fixed
+evaluation.
+
+Environment:
+    FAKE_STOCKFISH_HANG: While this file exists, the next `go` takes it (so
+        only one engine does) and never answers
+    FAKE_STOCKFISH_SEARCH_TIME: Seconds every `go` takes
+"""
+import os
+import sys
+import time
+
+STARTPOS = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+
+def out(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def main():
+    fen = STARTPOS
+    out('Stockfish 15.1 by the Stockfish developers (see AUTHORS file)')
+    for line in sys.stdin:
+        line = line.strip()
+        if line == 'uci':
+            out('id name Stockfish 15.1')
+            out('uciok')
+        elif line == 'isready':
+            out('readyok')
+        elif line.startswith('position fen '):
+            fen = line[len('position fen '):].split(' moves ')[0]
+        elif line.startswith('position startpos'):
+            fen = STARTPOS
+        elif line == 'd':
+            out(f'Fen: {fen}')
+            out('Checkers: ')
+        elif line.startswith('go'):
+            hang = os.environ.get('FAKE_STOCKFISH_HANG')
+            if hang:
+                try:
+                    os.rename(hang, f'{hang}.taken')
+                    time.sleep(3600)
+                except OSError:
+                    pass
+            time.sleep(float(os.environ.get('FAKE_STOCKFISH_SEARCH_TIME', '0')))
+            out('info depth 1 seldepth 1 multipv 1 score cp 13 nodes 20 pv e2e4')
+            out('bestmove e2e4')
+        elif line == 'quit':
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from chessflix.services.chess_dot_com_service import ChessDotComService
+
+
+def serve_archives(server, username, months):
+    """Serves `months` (month -> PGNs, oldest month first) as the archives of
+    `username`. Returns the archive paths, newest month first."""
+    paths = [f'/pub/player/{username}/games/{month}' for month in months]
+    server.responses[f'/pub/player/{username}/games/archives'] = {
+        'archives': [server.url + path for path in paths]}
+    for path, pgns in zip(paths, months.values()):
+        server.responses[path] = {'games': [{'pgn': pgn} for pgn in pgns]}
+    return paths[::-1]
+
+
+def month_pgns(months, games):
+    return {month: [f'{month} game {i}' for i in range(games)] for month in months}
+
+
+def test_rate_limited_and_failed_requests_are_retried(chess_com_server):
+    paths = serve_archives(chess_com_server, 'player', month_pgns(['2023/01'], 3))
+    chess_com_server.failures['/pub/player/player/games/archives'] = [429, 503]
+    chess_com_server.failures[paths[0]] = [500]
+    service = ChessDotComService.build(base_url=chess_com_server.url, retries=3)
+
+    games = service.get_games_by_username('player', get_pgns=True)
+
+    assert games == ['2023/01 game 0', '2023/01 game 1', '2023/01 game 2']
+    assert chess_com_server.requested.count('/pub/player/player/games/archives') == 3
+    assert chess_com_server.requested.count(paths[0]) == 2
+
+
+def test_requests_give_up_after_the_retries(chess_com_server):
+    serve_archives(chess_com_server, 'player', month_pgns(['2023/01'], 3))
+    chess_com_server.failures['/pub/player/player/games/archives'] = [503, 503, 503]
+    service = ChessDotComService.build(base_url=chess_com_server.url, retries=1)
+
+    assert service.get_games_by_username('player', get_pgns=True) == []
+    assert chess_com_server.requested == ['/pub/player/player/games/archives'] * 2
+
+
+def test_requests_to_a_host_are_limited(chess_com_server):
+    chess_com_server.delay = 0.05
+    urls = []
+    for i in range(12):
+        chess_com_server.responses[f'/pub/player/opponent{i}'] = {'username': f'opponent{i}'}
+        urls.append(f'{chess_com_server.url}/pub/player/opponent{i}')
+    service = ChessDotComService.build(
+        base_url=chess_com_server.url, max_workers=8, per_host=2)
+
+    profiles = service.get_profiles(urls)
+
+    assert [profile['username'] for profile in profiles] == [f'opponent{i}' for i in range(12)]
+    assert chess_com_server.max_in_flight == 2
+
+
+def test_limit_is_exact_across_archives(chess_com_server):
+    serve_archives(chess_com_server, 'player', month_pgns(['2023/01', '2023/02', '2023/03'], 4))
+    service = ChessDotComService.build(base_url=chess_com_server.url)
+
+    assert service.get_games_by_username('player', get_pgns=True, limit=6) == [
+        '2023/03 game 0', '2023/03 game 1', '2023/03 game 2', '2023/03 game 3',
+        '2023/02 game 0', '2023/02 game 1']
+    assert len(service.get_games_by_username('player', get_pgns=True, limit=4)) == 4
+    assert len(service.get_games_by_username('player', get_pgns=True, limit=12)) == 12
+    assert len(service.get_games_by_username('player', get_pgns=True, limit=None)) == 12
+    assert service.get_games_by_username('player', get_pgns=True, limit=0) == []
+
+
+def test_archives_after_the_limit_are_not_fetched(chess_com_server):
+    paths = serve_archives(
+        chess_com_server, 'player', month_pgns(['2023/01', '2023/02', '2023/03', '2023/04'], 3))
+    service = ChessDotComService.build(base_url=chess_com_server.url, read_ahead=1)
+
+    assert len(service.get_games_by_username('player', get_pgns=True, limit=3)) == 3
+    service.get_executor().shutdown()
+    assert chess_com_server.requested == ['/pub/player/player/games/archives', paths[0]]
+
+    chess_com_server.requested.clear()
+    service = ChessDotComService.build(base_url=chess_com_server.url, read_ahead=1)
+    assert len(service.get_games_by_username('player', get_pgns=True, limit=4)) == 4
+    service.get_executor().shutdown()
+    assert chess_com_server.requested == ['/pub/player/player/games/archives', paths[0], paths[1]]
+
+
+def test_closing_the_stream_stops_fetching_archives(chess_com_server):
+    paths = serve_archives(
+        chess_com_server, 'player', month_pgns(['2023/01', '2023/02', '2023/03', '2023/04'], 3))
+    service = ChessDotComService.build(base_url=chess_com_server.url, read_ahead=1)
+
+    games = service.iter_games_by_username('player', get_pgns=True, limit=None)
+    assert next(games) == '2023/04 game 0'
+    games.close()
+    service.get_executor().shutdown()
+
+    assert paths[2] not in chess_com_server.requested
+    assert paths[3] not in chess_com_server.requested
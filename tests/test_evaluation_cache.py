@@ -0,0 +1,58 @@
+from chessflix.services.evaluation_cache import EvaluationCache
+
+FEN = 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1'
+ENGINE = 'stockfish-15'
+
+
+def test_lookups_are_served_by_entries_at_least_as_deep():
+    cache = EvaluationCache.build(':memory:')
+    cache.put(FEN, ENGINE, 12, {'type': 'cp', 'value': 35})
+
+    assert cache.get(FEN, ENGINE, 10) == {'type': 'cp', 'value': 35, 'depth': 12}
+    assert cache.get(FEN, ENGINE, 12) == {'type': 'cp', 'value': 35, 'depth': 12}
+    assert cache.get(FEN, ENGINE, 14) is None
+    assert cache.get(FEN, 'stockfish-16', 10) is None
+    # Move counters are not part of the position
+    assert cache.get(FEN.replace(' 0 1', ' 3 20'), ENGINE, 12)['depth'] == 12
+
+    stats = cache.get_stats()
+    assert stats['memory']['hits'] == 3
+    assert stats['memory']['misses'] == 2
+    assert stats['disk_misses'] == 2
+
+
+def test_only_deeper_evaluations_replace_an_entry():
+    cache = EvaluationCache.build(':memory:')
+    cache.put(FEN, ENGINE, 12, {'type': 'cp', 'value': 35})
+    cache.put(FEN, ENGINE, 8, {'type': 'cp', 'value': 90})
+    assert cache.get(FEN, ENGINE, 1) == {'type': 'cp', 'value': 35, 'depth': 12}
+
+    cache.put(FEN, ENGINE, 16, {'type': 'mate', 'value': 7})
+    assert cache.get(FEN, ENGINE, 16) == {'type': 'mate', 'value': 7, 'depth': 16}
+    assert cache.get_stats()['disk_entries'] == 1
+
+
+def test_entries_persist_across_caches(tmp_path):
+    path = str(tmp_path / 'evaluations.db')
+    EvaluationCache.build(path).put(FEN, ENGINE, 12, {'type': 'cp', 'value': 35})
+
+    cache = EvaluationCache.build(path)
+    assert cache.get(FEN, ENGINE, 12) == {'type': 'cp', 'value': 35, 'depth': 12}
+    assert cache.get(FEN, ENGINE, 12) == {'type': 'cp', 'value': 35, 'depth': 12}
+    stats = cache.get_stats()
+    assert stats['disk_hits'] == 1
+    assert stats['memory']['hits'] == 1
+
+
+def test_deeper_disk_entry_serves_a_lookup_the_memory_entry_is_too_shallow_for(tmp_path):
+    path = str(tmp_path / 'evaluations.db')
+    EvaluationCache.build(path).put(FEN, ENGINE, 12, {'type': 'cp', 'value': 35})
+    cache = EvaluationCache.build(path)
+    # Only the memory tier takes the shallower evaluation
+    cache.put(FEN, ENGINE, 8, {'type': 'cp', 'value': 90})
+
+    assert cache.get(FEN, ENGINE, 10) == {'type': 'cp', 'value': 35, 'depth': 12}
+    stats = cache.get_stats()
+    assert stats['memory']['hits'] == 0
+    assert stats['memory']['misses'] == 1
+    assert stats['disk_hits'] == 1
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from chessflix.services.radar_context import RAW_FEATURES
+from chessflix.services.radar_service import RadarService
+from handlers.evaluation_handler import EvaluationHandler
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+MOVES = ['e2e4', 'e7e5', 'g1f3', 'b8c6', 'f1b5', 'a7a6', 'b5a4', 'g8f6']
+
+
+def cp(*values):
+    return [{'type': 'cp', 'value': value} for value in values]
+
+
+def no_features(plies):
+    return np.zeros((plies, len(RAW_FEATURES), 2))
+
+
+@pytest.fixture
+def build_handler(engine_pool):
+    """Handler over a pool of fake engines, which read their environment
+    when they start."""
+    def build():
+        return EvaluationHandler(
+            stockfish_service=engine_pool(2),
+            radar_service=RadarService(normalize_scores=False),
+            engine_workers=1,
+        )
+    return build
+
+
+def test_evaluation_swings_mark_both_plies_around_them():
+    evaluations = cp(0, 10, 200, 190, 20, 60)
+
+    assert EvaluationHandler.get_critical_plies(evaluations, no_features(6), swing=100) == [1, 2, 3, 4]
+    assert EvaluationHandler.get_critical_plies(evaluations, no_features(6), swing=180) == [1, 2]
+
+
+def test_feature_spikes_mark_their_ply():
+    raw = no_features(5)
+    strong_threats = RAW_FEATURES.index('strong_threats')
+    forks = RAW_FEATURES.index('forks')
+    raw[2:, strong_threats, 0] = 4
+    raw[4:, forks, 1] = 6
+    # Falls back at ply 1, which is no spike
+    raw[0, forks, 0] = 5
+
+    assert EvaluationHandler.get_critical_plies(
+        cp(0, 0, 0, 0, 0), raw, swing=100, feature_spike=3) == [4, 2]
+
+
+def test_mate_scores_count_as_large_swings():
+    evaluations = [
+        {'type': 'cp', 'value': 50},
+        {'type': 'mate', 'value': 3},
+        {'type': 'mate', 'value': 2},
+        {},
+        {'type': 'mate', 'value': -4},
+        {'type': 'cp', 'value': -9000},
+    ]
+
+    # A mate found (ply 1) scores 10000 - 50; a position without an
+    # evaluation (ply 3) is no swing; mate to -9000 is a 1000 swing
+    assert EvaluationHandler.get_critical_plies(
+        evaluations, no_features(6), swing=500) == [0, 1, 4, 5]
+
+
+def test_max_deepened_caps_the_deep_pass(build_handler):
+    handler = build_handler()
+    # The fake engine scores every position +13 for the side to move, so
+    # each ply swings by 26
+    result = handler.calculate_adaptive_game_evaluations(
+        START_FEN, MOVES, shallow_depth=6, depth=12, swing=20, max_deepened=3)
+
+    assert len(result['deepened']) == 3
+    assert result['depths'] == [12 if ply in result['deepened'] else 6 for ply in range(len(MOVES))]
+    assert result['evaluations'] == [-13, 13] * 4
+
+
+def test_deep_pass_runs_within_the_deadline(build_handler):
+    result = build_handler().calculate_adaptive_game_evaluations(
+        START_FEN, MOVES, swing=20, budget={'deadline': 60000})
+
+    assert result['deepened'] == list(range(len(MOVES)))
+
+
+def test_deep_pass_is_skipped_when_the_deadline_is_used_up(build_handler, monkeypatch):
+    # Every search overruns its share of the deadline
+    monkeypatch.setenv('FAKE_STOCKFISH_SEARCH_TIME', '0.05')
+    handler = build_handler()
+
+    result = handler.calculate_adaptive_game_evaluations(
+        START_FEN, MOVES, swing=20, budget={'deadline': 200})
+
+    assert result['deepened'] == []
+    assert handler.stockfish_service.get_stats()['checkouts'] == len(MOVES)
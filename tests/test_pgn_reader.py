@@ -0,0 +1,61 @@
+import io
+
+import chess.pgn
+import pytest
+
+from chessflix.services.pgn_reader import read_headers, read_moves
+
+PGNS = {
+    'clock comments': (
+        '[Event "Live Chess"]\n[Date "2023.06.26"]\n[StartTime "18:01:02"]\n\n'
+        '1. e4 {[%clk 0:02:59.9]} 1... e5 {[%clk 0:02:58.1]} 2. Nf3 {[%clk 0:02:57]} '
+        '2... Nc6 {[%clk 0:02:55.2]} 1-0\n'),
+    'nags': (
+        '[Event "NAGs"]\n\n'
+        '1. e4 $1 e5 $2 2. Nf3! Nc6? 3. Bb5!! a6?? 4. Ba4!? Nf6?! 1/2-1/2\n'),
+    'nested variations': (
+        '[Event "Variations"]\n\n'
+        '1. e4 e5 2. Nf3 (2. f4 exf4 (2... d5 3. exd5) 3. Nf3) (2. Bc4) 2... Nc6 '
+        '3. Bb5 (3. Bc4 Bc5 (3... Nf6)) 3... a6 0-1\n'),
+    'brackets in comments': (
+        '[Event "Comments"]\n\n'
+        '1. d4 (1. e4 {a comment with a ) inside} e5 {and ( another}) 1... d5 '
+        '{(not a variation} 2. c4 {closing ) only} e6 *\n'),
+    'line comments': (
+        '[Event "Line comments"]\n\n'
+        '1. e4 ; 1... e5 is not a move\n1... c5 2. Nf3 d6 3. d4 cxd4 4. Nxd4 Nf6 '
+        '5. Nc3 a6 6. Be3 e5 7. Nb3 Be6 8. f3 Be7 9. Qd2 O-O 10. O-O-O 0-1\n'),
+    'promotions': (
+        '[Event "Promotions"]\n[SetUp "1"]\n[FEN "4k3/1P6/8/8/8/8/6p1/4K3 w - - 0 1"]\n\n'
+        '1. b8=Q+ Kd7 2. Qb5+ Kc7 3. Kd2 g1=N 4. Qc4+ Kd6 5. Qf4+ Ke6 1/2-1/2\n'),
+    'escaped headers': (
+        '[Event "A \\"quoted\\" event"]\n[Site "C:\\\\chess"]\n\n1. e4 e5 *\n'),
+    'illegal move': (
+        '[Event "Illegal"]\n\n1. e4 e5 2. Ke3 Nc6 3. Nf3 *\n'),
+}
+
+
+def assert_matches_read_game(pgn):
+    game = chess.pgn.read_game(io.StringIO(pgn))
+    headers, board, moves = read_moves(pgn)
+    assert headers == {tag: game.headers[tag] for tag in headers}
+    assert set(game.headers) - set(headers) <= set(chess.pgn.TAG_ROSTER)
+    assert board == game.board()
+    assert moves == list(game.mainline_moves())
+
+
+@pytest.mark.parametrize('name', PGNS)
+def test_read_moves_matches_read_game(name):
+    assert_matches_read_game(PGNS[name])
+
+
+def test_read_moves_matches_read_game_on_the_corpus(corpus_pgns):
+    for pgn in corpus_pgns:
+        assert_matches_read_game(pgn)
+
+
+def test_read_headers_returns_the_movetext_offset():
+    headers, offset = read_headers(PGNS['promotions'])
+    assert headers == {
+        'Event': 'Promotions', 'SetUp': '1', 'FEN': '4k3/1P6/8/8/8/8/6p1/4K3 w - - 0 1'}
+    assert PGNS['promotions'][offset:].startswith('1. b8=Q+')
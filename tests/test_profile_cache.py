@@ -0,0 +1,115 @@
+import threading
+
+import pytest
+
+from chessflix.services import lru_cache
+from chessflix.services.chess_dot_com_service import ChessDotComService
+from chessflix.services.lru_cache import LRUCache
+from conftest import FakeResponse
+
+URL = 'https://api.chess.com/pub/player/opponent'
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(lru_cache, 'time', clock)
+    return clock
+
+
+def build_service(session, **kwargs):
+    return ChessDotComService(
+        session=session,
+        profile_cache=LRUCache.build(max_entries=100, ttl=kwargs.pop('ttl', 86400)),
+        **kwargs)
+
+
+def test_profiles_are_fetched_once_per_id(fake_session):
+    fake_session.responses[f'{URL}1'] = {'username': 'opponent1'}
+    fake_session.responses[f'{URL}2'] = {'username': 'opponent2'}
+    service = build_service(fake_session)
+
+    profiles = service.get_profiles([f'{URL}1', f'{URL}2', f'{URL}1', f'{URL}1', f'{URL}2'])
+    again = service.get_profile(f'{URL}2')
+
+    assert [profile['username'] for profile in profiles] == [
+        'opponent1', 'opponent2', 'opponent1', 'opponent1', 'opponent2']
+    assert again['username'] == 'opponent2'
+    assert sorted(fake_session.requested) == [f'{URL}1', f'{URL}2']
+
+
+def test_profiles_expire_after_the_ttl(fake_session, clock):
+    fake_session.responses[URL] = {'username': 'opponent'}
+    service = build_service(fake_session, ttl=60)
+
+    service.get_profile(URL)
+    clock.now += 59
+    service.get_profile(URL)
+    assert len(fake_session.requested) == 1
+    clock.now += 2
+    assert service.get_profile(URL)['username'] == 'opponent'
+    assert len(fake_session.requested) == 2
+
+
+def test_failed_lookups_are_cached_for_the_negative_ttl(fake_session, clock):
+    service = build_service(fake_session, negative_ttl=600)
+
+    assert service.get_profile(URL) == {}
+    # Fixed upstream, but the failure is not retried yet
+    fake_session.responses[URL] = {'username': 'opponent'}
+    clock.now += 599
+    assert service.get_profile(URL) == {}
+    assert len(fake_session.requested) == 1
+    clock.now += 2
+    assert service.get_profile(URL)['username'] == 'opponent'
+    assert len(fake_session.requested) == 2
+
+
+def test_concurrent_lookups_share_one_fetch(fake_session):
+    release = threading.Event()
+
+    def slow_profile():
+        release.wait(5)
+        return FakeResponse({'username': 'opponent'})
+
+    fake_session.responses[URL] = slow_profile
+    service = build_service(fake_session)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(service.get_profile(URL)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert [profile['username'] for profile in results] == ['opponent'] * 4
+    assert fake_session.requested == [URL]
+    assert not service.profile_fetches
+
+
+def test_profile_cache_round_trips_through_the_file(fake_session, tmp_path):
+    profile_cache_file = str(tmp_path / 'profiles.json')
+    fake_session.responses[f'{URL}1'] = {'username': 'opponent1'}
+    service = ChessDotComService.build(profile_cache_file=profile_cache_file)
+    service.session = fake_session
+    service.get_profiles([f'{URL}1', f'{URL}2'])
+
+    reloaded = ChessDotComService.build(profile_cache_file=profile_cache_file)
+    reloaded.session = fake_session
+    profiles = reloaded.get_profiles([f'{URL}1', f'{URL}2'])
+
+    assert profiles[0]['username'] == 'opponent1'
+    # The failed lookup was saved as one
+    assert profiles[1] == {}
+    assert len(fake_session.requested) == 2
@@ -0,0 +1,52 @@
+import chess
+import pytest
+
+from chessflix.services import radar_bitboards
+from chessflix.services.radar_service import RadarService
+
+KERNELS = [
+    'space',
+    'material_balance',
+    'pawn_structure_health',
+    'central_control',
+    'kingside_attack',
+    'queenside_attack',
+]
+# Kernels that can reuse the attacked squares of a RadarContext
+ATTACK_KERNELS = ['space', 'central_control', 'kingside_attack', 'queenside_attack']
+
+
+@pytest.fixture(scope='module')
+def radar_service():
+    return RadarService(normalize_scores=False)
+
+
+def find_mismatches(feature, radar_service, boards, shared_attacks=False):
+    kernel = getattr(radar_bitboards, f'calculate_{feature}')
+    reference = getattr(radar_service, f'calculate_{feature}')
+    mismatches = []
+    for board in boards:
+        fen = board.fen()
+        expected = reference(fen)
+        expected = (expected['white_score'], expected['black_score'])
+        if shared_attacks:
+            attacked = [radar_bitboards.attacked_squares(board, color) for color in (chess.BLACK, chess.WHITE)]
+            actual = kernel(board, attacked)
+        else:
+            actual = kernel(board)
+        # repr also tells an int score from an equal float one
+        if repr(actual) != repr(expected):
+            mismatches.append(f'{fen}: {actual!r} != {expected!r}')
+    return mismatches
+
+
+@pytest.mark.parametrize('feature', KERNELS)
+def test_kernel_matches_fen_method(feature, radar_service, corpus_boards):
+    mismatches = find_mismatches(feature, radar_service, corpus_boards)
+    assert not mismatches, f'{len(mismatches)} mismatches:\n' + '\n'.join(mismatches[:10])
+
+
+@pytest.mark.parametrize('feature', ATTACK_KERNELS)
+def test_kernel_with_shared_attacks_matches_fen_method(feature, radar_service, corpus_boards):
+    mismatches = find_mismatches(feature, radar_service, corpus_boards, shared_attacks=True)
+    assert not mismatches, f'{len(mismatches)} mismatches:\n' + '\n'.join(mismatches[:10])
@@ -0,0 +1,48 @@
+import pytest
+
+from chessflix.services.radar_context import RadarContext
+from chessflix.services.radar_incremental import IncrementalRadar
+from chessflix.services.radar_service import RadarService
+
+
+@pytest.fixture(scope='module')
+def radar_service():
+    return RadarService(normalize_scores=False)
+
+
+def test_incremental_features_match_fen_reference(radar_service, corpus_games):
+    mismatches = []
+    for start, moves in corpus_games:
+        board = start.copy()
+        features = radar_service.to_feature_dicts(
+            radar_service.get_features_by_moves(start, moves))
+        for move, incremental in zip(moves, features):
+            board.push(move)
+            expected = radar_service.get_features_by_fen(board.fen(), shared_context=False)
+            for attr, scores in incremental.items():
+                if scores != expected[attr]:
+                    mismatches.append(f'{attr} after {move} in {board.fen()}: {scores} != {expected[attr]}')
+    assert not mismatches, f'{len(mismatches)} mismatches:\n' + '\n'.join(mismatches[:10])
+
+
+def test_incremental_raw_features_match_full_context(corpus_games):
+    for start, moves in corpus_games:
+        radar = IncrementalRadar.build(start)
+        board = start.copy()
+        for move in moves:
+            radar.push(move)
+            board.push(move)
+            assert radar.calculate_raw_features() == RadarContext.build(board).calculate_raw_features(), board.fen()
+
+
+def test_segments_match_single_pass(corpus_games):
+    radar_service = RadarService(normalize_scores=False)
+    executor = RadarService.start_workers(2)
+    try:
+        segmented = RadarService(normalize_scores=False, executor=executor, workers=2)
+        for start, moves in corpus_games:
+            expected = radar_service.get_raw_features_by_moves(start, moves)
+            actual = segmented.get_raw_features_by_moves(start, moves, workers=2, min_segment=10)
+            assert (actual == expected).all()
+    finally:
+        executor.shutdown()
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+
+from chessflix.services.radar_context import RADAR_FEATURES, RAW_FEATURES
+from chessflix.services.radar_profile import RadarProfile
+from chessflix.services.radar_service import RadarService
+
+STATS_FILE = os.path.join(
+    os.path.dirname(__file__), '..', 'trained_stats_MagnusCarlsen_1000_2023-06-26.json')
+
+
+@pytest.fixture(scope='module')
+def radar_service():
+    return RadarService(normalize_scores=True, profile=RadarProfile.load(STATS_FILE))
+
+
+def test_normalize_batch_matches_calculate_final_score(radar_service, corpus_boards):
+    mismatches = []
+    for board in corpus_boards[::5]:
+        fen = board.fen()
+        features = radar_service.get_features_by_fen(fen)
+        expected = radar_service.get_features_by_fen(fen, shared_context=False)
+        for attr, scores in features.items():
+            if scores != expected[attr]:
+                mismatches.append(f'{attr} in {fen}: {scores} != {expected[attr]}')
+    assert not mismatches, f'{len(mismatches)} mismatches:\n' + '\n'.join(mismatches[:10])
+
+
+def test_normalize_batch_rounds_like_calculate_final_score():
+    # Scaled to 0.04135, 0.05615, ... whose nearest doubles lie just below the
+    # half, where np.round and Python's round disagree
+    values = [-1.97519, -1.96631, -1.96109, -1.95743, -1.95065, 0.5, 2.25]
+    radar_service = RadarService(normalize_scores=True, profile=RadarProfile.build({
+        'trained_stats': {attr: {'mean': 1, 'std_dev': 1} for attr in RADAR_FEATURES}}))
+    raw = np.zeros((len(values), len(RAW_FEATURES), 2))
+    raw[:, RAW_FEATURES.index('space')] = np.array(values)[:, None]
+    scaled = radar_service.normalize_batch(raw)[:, RADAR_FEATURES.index('space')]
+    for value, scores in zip(values, scaled.tolist()):
+        expected = radar_service.calculate_final_score(
+            {'attribute': 'space', 'white_score': value, 'black_score': value})
+        assert scores == [expected['white_score'], expected['black_score']], value
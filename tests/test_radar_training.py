@@ -0,0 +1,69 @@
+import pytest
+
+from chessflix.services import radar_service
+from chessflix.services.chess_dot_com_service import ChessDotComService
+from chessflix.services.radar_service import RadarService
+from chessflix.services.radar_training import train_games
+
+BASE_URL = 'https://api.chess.com'
+
+
+def serve_archives(session, username, months):
+    """Serves `months` (month -> PGNs, oldest month first) as the chess.com
+    archives of `username`. The PGN lists are read on every request, so
+    games appended to them show up as newly played ones."""
+    archives = [f'{BASE_URL}/pub/player/{username}/games/{month}' for month in months]
+    session.responses[f'{BASE_URL}/pub/player/{username}/games/archives'] = {
+        'archives': archives}
+    for month, pgns in months.items():
+        session.responses[f'{BASE_URL}/pub/player/{username}/games/{month}'] = {
+            'games': [{'pgn': pgn} for pgn in pgns]}
+
+
+def train(session, **kwargs):
+    radar = RadarService(
+        chessdotcom_service=ChessDotComService(session=session),
+        normalize_scores=False)
+    return radar.train_stats_by_username('player', **kwargs)
+
+
+def test_resumed_training_matches_an_uninterrupted_run(tmp_path, monkeypatch, fake_session, corpus_pgns):
+    monkeypatch.chdir(tmp_path)
+    months = {'2023/01': corpus_pgns[:6], '2023/02': corpus_pgns[6:12]}
+    serve_archives(fake_session, 'player', months)
+    expected = train(fake_session, limit=9, chunk_size=2)
+
+    calls = []
+
+    def interrupted_train_games(*args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        return train_games(*args)
+
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+    monkeypatch.setattr(radar_service, 'train_games', interrupted_train_games)
+    with pytest.raises(KeyboardInterrupt):
+        train(fake_session, limit=9, chunk_size=2, checkpoint_file=checkpoint_file)
+    # Games played before the run is resumed come before the checkpoint in
+    # the newest first stream and must not shift it
+    months['2023/02'].append(corpus_pgns[12])
+    months['2023/03'] = [corpus_pgns[13]]
+    serve_archives(fake_session, 'player', months)
+    monkeypatch.setattr(radar_service, 'train_games', train_games)
+    resumed = train(fake_session, limit=9, chunk_size=2, checkpoint_file=checkpoint_file)
+
+    assert resumed == expected
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+
+def test_training_stats_do_not_depend_on_workers_or_chunk_size(tmp_path, monkeypatch, fake_session, corpus_pgns):
+    monkeypatch.chdir(tmp_path)
+    serve_archives(fake_session, 'player', {
+        '2023/01': corpus_pgns[:5], '2023/02': corpus_pgns[5:10]})
+    expected = train(fake_session, limit=10, chunk_size=10)
+
+    assert train(fake_session, limit=10, chunk_size=1) == expected
+    assert train(fake_session, limit=10, chunk_size=3) == expected
+    assert train(fake_session, limit=10, chunk_size=3, parallel=True, workers=2) == expected
+    assert train(fake_session, limit=10, chunk_size=4, parallel=True, workers=3) == expected
@@ -0,0 +1,200 @@
+import subprocess
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import stockfish.models
+from stockfish import StockfishException
+
+from chessflix.services.stockfish_service import BATCH, INTERACTIVE, StockfishService
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+
+def test_checkout_lends_each_engine_to_one_caller(engine_pool):
+    service = engine_pool(2)
+    lock = threading.Lock()
+    in_use = []
+    overlaps = []
+    most = []
+
+    def work():
+        for _ in range(5):
+            with service.checkout() as fish:
+                with lock:
+                    if fish in in_use:
+                        overlaps.append(fish)
+                    in_use.append(fish)
+                    most.append(len(in_use))
+                fish.set_fen_position(START_FEN)
+                fish.get_evaluation()
+                with lock:
+                    in_use.remove(fish)
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not overlaps
+    assert max(most) == 2
+    assert service.get_stats()['checkouts'] == 30
+    assert len(service.idle) == 2
+
+
+def test_engine_is_checked_in_when_the_caller_raises(engine_pool):
+    service = engine_pool(1)
+
+    with pytest.raises(ValueError):
+        with service.checkout() as fish:
+            raise ValueError('caller failed')
+
+    with service.checkout(timeout=1) as again:
+        assert again is fish
+    assert service.idle == [fish]
+
+
+def test_checkout_times_out_when_every_engine_is_busy(engine_pool):
+    service = engine_pool(1, checkout_timeout=0.1)
+
+    with service.checkout():
+        started = time.monotonic()
+        with pytest.raises(Exception, match='No Stockfish engine available after 0.1s'):
+            with service.checkout():
+                pass
+        assert time.monotonic() - started >= 0.1
+
+    assert service.get_stats()['timeouts'] == 1
+    with service.checkout():
+        pass
+
+
+def test_session_goes_back_to_its_engine(engine_pool):
+    service = engine_pool(3)
+    with service.checkout(session='game') as bound:
+        pass
+    # Other work in between takes the engines no session is using
+    with service.checkout() as first, service.checkout(session='other') as second:
+        assert bound not in (first, second)
+
+    with service.checkout(session='game') as fish:
+        assert fish is bound
+        assert service.is_warm(fish, 'game')
+    assert service.get_stats()['affinity_hits'] == 1
+
+
+def test_session_waits_briefly_for_its_busy_engine(engine_pool):
+    service = engine_pool(2, affinity_wait=2)
+    with service.checkout(session='game') as bound:
+        pass
+    held = threading.Event()
+
+    def hold():
+        with service.checkout(session='game'):
+            held.set()
+            time.sleep(0.1)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    with service.checkout(session='game') as fish:
+        assert fish is bound
+    thread.join()
+    assert service.get_stats()['affinity_misses'] == 0
+
+
+def test_session_falls_back_after_the_affinity_wait(engine_pool):
+    service = engine_pool(2, affinity_wait=0.2)
+    with service.checkout(session='game') as bound:
+        pass
+
+    with service.checkout(session='game') as held:
+        assert held is bound
+        started = time.monotonic()
+        with service.checkout(session='game') as fish:
+            waited = time.monotonic() - started
+        assert fish is not bound
+
+    assert 0.2 <= waited < 2
+    assert service.get_stats()['affinity_misses'] == 1
+
+
+def test_batch_work_leaves_an_engine_for_interactive_requests(engine_pool, monkeypatch):
+    monkeypatch.setenv('FAKE_STOCKFISH_SEARCH_TIME', '0.2')
+    service = engine_pool(3, batch_limit=2)
+    batch_in_use = []
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            with service.lock:
+                batch_in_use.append(service.classes[BATCH]['in_use'])
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    batch = threading.Thread(
+        target=service.get_evaluations, args=([START_FEN] * 8,),
+        kwargs={'workers': 3, 'priority': BATCH})
+    batch.start()
+    while 2 not in batch_in_use:
+        time.sleep(0.001)
+    evaluation = service.get_evaluation(START_FEN)
+    batch.join()
+    done.set()
+    sampler.join()
+
+    assert evaluation['value'] == 13
+    assert max(batch_in_use) == 2
+    stats = service.get_stats()['classes']
+    assert stats[BATCH]['checkouts'] == 8
+    assert stats[INTERACTIVE]['max_wait_time'] < 0.1
+
+
+def test_hung_engine_is_replaced_and_the_search_retried(engine_pool, monkeypatch, tmp_path):
+    hang = tmp_path / 'hang'
+    hang.touch()
+    monkeypatch.setenv('FAKE_STOCKFISH_HANG', str(hang))
+    service = engine_pool(2, call_timeout=0.3)
+    engines = list(service.engines)
+    done = threading.Event()
+
+    def supervise():
+        while not done.is_set():
+            service.check_engines()
+            time.sleep(0.05)
+
+    supervisor = threading.Thread(target=supervise)
+    supervisor.start()
+    try:
+        evaluation = service.get_evaluation(START_FEN)
+    finally:
+        done.set()
+        supervisor.join()
+    deadline = time.monotonic() + 10
+    while service.get_stats()['spawning'] and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert evaluation['value'] == 13
+    assert (tmp_path / 'hang.taken').exists()
+    stats = service.get_stats()
+    assert stats['hung'] == 1
+    assert stats['retries'] == 1
+    assert stats['restarts'] == 1
+    assert stats['size'] == 2
+    hung = [fish for fish in engines if fish not in service.engines]
+    assert len(hung) == 1 and not hung[0].is_alive()
+
+
+def test_start_timeout_before_the_process_exists_fails_the_start(fake_stockfish, monkeypatch):
+    def slow_popen(*args, **kwargs):
+        time.sleep(0.3)
+        return subprocess.Popen(*args, **kwargs)
+
+    monkeypatch.setattr(stockfish.models, 'subprocess', SimpleNamespace(
+        Popen=slow_popen, PIPE=subprocess.PIPE, STDOUT=subprocess.STDOUT))
+
+    with pytest.raises(StockfishException):
+        StockfishService.spawn_engine(fake_stockfish, {}, timeout=0.05)